@@ -7,9 +7,23 @@
 import re
 import os
 import sys
+import mmap
+import struct
+import bisect
+import select
+import signal
+import hashlib
+import binascii
+import argparse
 import subprocess
+import collections
+import multiprocessing
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
  
-_bt_line_regex = re.compile(r'.*? - (?P<path>.+)\((?P<func>.*?)(\+0x[0-9a-f]+)?\) \[(?P<addr>0x[0-9a-f]+)\]')
+_bt_line_regex = re.compile(r'.*? - (?P<path>.+)\((?P<func>.*?)(?P<offset>\+0x[0-9a-f]+)?\) \[(?P<addr>0x[0-9a-f]+)\]')
  
 def _run_cmd(cmd):
     """run cmd(string) and return it's stdout"""
@@ -20,34 +34,539 @@ def _run_cmd(cmd):
     )
     return cmdProc.communicate()[0]
  
-def main(object_file):
-    for line in sys.stdin:
-        # extract function name and return address
-        # from backtrace's output
+class _CoProcess(object):
+    """long-lived filter process over pipes, answers one line per input line"""
+
+    def __init__(self, args):
+        self._args = args
+        self._proc = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True
+        )
+
+    # pipes hold at least a page, a batch of at most this many bytes is written
+    # without blocking even while the answers fill the other pipe
+    BATCH_BYTES = 4096
+
+    def _batches(self, lines):
+        """split lines into batches of BATCH_SIZE lines and BATCH_BYTES bytes at most,
+        a longer line goes alone, it is read whole before being answered"""
+        batch = []
+        size = 0
+        for line in lines:
+            line = '{}\n'.format(line)
+            if batch and (len(batch) == _Symbolizer.BATCH_SIZE or size + len(line) > self.BATCH_BYTES):
+                yield batch
+                batch = []
+                size = 0
+            batch.append(line)
+            size += len(line)
+        if batch:
+            yield batch
+
+    def query(self, lines):
+        """send lines in batches small enough not to fill the pipes, return the answers"""
+        results = []
+        for batch in self._batches(lines):
+            self._proc.stdin.write(''.join(batch))
+            self._proc.stdin.flush()
+            for _ in batch:
+                answer = self._proc.stdout.readline()
+                if not answer:
+                    raise RuntimeError('{} exited unexpectedly'.format(self._args[0]))
+                results.append(answer.rstrip('\n'))
+        return results
+
+    def close(self):
+        self._proc.stdin.close()
+        self._proc.wait()
+ 
+class _ElfSymbols(object):
+    """function symbols of an ELF object (.symtab and .dynsym) sorted by address,
+    read in-process from the memory mapped file, addresses are resolved with bisect"""
+
+    SHT_SYMTAB = 2
+    SHT_NOTE = 7
+    SHT_DYNSYM = 11
+    STT_FUNC = 2
+    STT_GNU_IFUNC = 10
+    NT_GNU_BUILD_ID = 3
+    ET_DYN = 3
+    CACHE_VERSION = 2
+
+    def __init__(self, addrs, ends, names, relocatable):
+        self._addrs = addrs
+        self._ends = ends
+        self._names = names
+        self._addrByName = None
+        # shared objects and PIE executables are loaded at a base address
+        # the runtime addresses are relative to
+        self.relocatable = relocatable
+
+    def __len__(self):
+        return len(self._addrs)
+
+    def lookup(self, addr):
+        """(function, offset) of addr, None if it is in no function"""
+        i = bisect.bisect_right(self._addrs, addr) - 1
+        if i < 0 or addr >= self._ends[i]:
+            return None
+        return self._names[i], addr - self._addrs[i]
+
+    def address(self, name):
+        """address of the function name, None if unknown"""
+        if self._addrByName is None:
+            self._addrByName = dict(zip(self._names, self._addrs))
+        return self._addrByName.get(name)
+
+    @classmethod
+    def load(cls, path, cacheDir=None):
+        """symbols of the ELF object path, None if it is not an ELF object.
+        with cacheDir the index is saved there keyed by the build-id of the object,
+        or by its path, size and mtime without build-id, and loaded next time"""
+        with open(path, 'rb') as f:
+            if f.read(4) != b'\x7fELF':
+                return None
+            f.seek(0)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            elf = _ElfFile(data)
+            cacheFile = None
+            if cacheDir:
+                buildId = elf.build_id()
+                if buildId:
+                    key = 'buildid-{}'.format(buildId)
+                else:
+                    st = os.stat(path)
+                    key = 'path-{}'.format(hashlib.md5('{}:{}:{}'.format(
+                        os.path.realpath(path), st.st_size, st.st_mtime).encode('utf-8')).hexdigest())
+                cacheFile = os.path.join(cacheDir, '{}.symidx'.format(key))
+                symbols = cls._load_cache(cacheFile)
+                if symbols is not None:
+                    return symbols
+            symbols = cls._from_elf(elf)
+        finally:
+            data.close()
+        if cacheFile:
+            symbols._save_cache(cacheFile)
+        return symbols
+
+    @classmethod
+    def _from_elf(cls, elf):
+        # (address, not from .symtab, name, end), .symtab names are preferred for aliases
+        entries = []
+        for secType in (cls.SHT_SYMTAB, cls.SHT_DYNSYM):
+            for name, value, size, symType in elf.symbols(secType):
+                if symType in (cls.STT_FUNC, cls.STT_GNU_IFUNC) and value and name:
+                    entries.append((value, secType != cls.SHT_SYMTAB, name, value + size))
+        entries.sort()
+        addrs, ends, names = [], [], []
+        for addr, _, name, end in entries:
+            if addrs and addrs[-1] == addr:
+                continue
+            if names and ends[-1] == addrs[-1]:
+                # no size, the function goes up to the next one
+                ends[-1] = addr
+            addrs.append(addr)
+            ends.append(end)
+            names.append(name)
+        return cls(addrs, ends, names, elf.type == cls.ET_DYN)
+
+    @classmethod
+    def _load_cache(cls, cacheFile):
+        try:
+            with open(cacheFile, 'rb') as f:
+                cached = pickle.load(f)
+        except Exception:
+            return None
+        if cached[0] != cls.CACHE_VERSION:
+            return None
+        return cls(*cached[1:])
+
+    def _save_cache(self, cacheFile):
+        """the cache is optional, errors are ignored"""
+        tmpFile = '{}.{}.tmp'.format(cacheFile, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(cacheFile)):
+                os.makedirs(os.path.dirname(cacheFile))
+            with open(tmpFile, 'wb') as f:
+                pickle.dump((self.CACHE_VERSION, self._addrs, self._ends, self._names, self.relocatable), f, 2)
+            os.rename(tmpFile, cacheFile)
+        except (IOError, OSError):
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+ 
+class _ElfFile(object):
+    """minimal ELF section and symbol table reader, 32/64 bits and both byte orders"""
+
+    def __init__(self, data):
+        self._data = data
+        is64 = data[4:5] == b'\x02'
+        order = '>' if data[5:6] == b'\x02' else '<'
+        if is64:
+            shoff, = struct.unpack_from(order + 'Q', data, 0x28)
+            shentsize, shnum, shstrndx = struct.unpack_from(order + 'HHH', data, 0x3a)
+            self._shdr = struct.Struct(order + 'IIQQQQIIQQ')
+            self._sym = struct.Struct(order + 'IBBHQQ')
+        else:
+            shoff, = struct.unpack_from(order + 'I', data, 0x20)
+            shentsize, shnum, shstrndx = struct.unpack_from(order + 'HHH', data, 0x2e)
+            self._shdr = struct.Struct(order + 'IIIIIIIIII')
+            self._sym = struct.Struct(order + 'IIIBBH')
+        self._is64 = is64
+        self.type, = struct.unpack_from(order + 'H', data, 0x10)
+        self._order = order
+        # (name offset, type, address, offset, size, link)
+        self._sections = []
+        for i in range(shnum if shoff else 0):
+            fields = self._shdr.unpack_from(data, shoff + i * shentsize)
+            self._sections.append((fields[0], fields[1], fields[3], fields[4], fields[5], fields[6]))
+        self._shstrtab = self._sections[shstrndx][3] if shstrndx < len(self._sections) else None
+
+    def _string(self, tableOffset, offset):
+        start = tableOffset + offset
+        name = self._data[start:self._data.find(b'\0', start)]
+        return name if isinstance(name, str) else name.decode('latin-1')
+
+    def _section_name(self, section):
+        if self._shstrtab is None:
+            return ''
+        return self._string(self._shstrtab, section[0])
+
+    def symbols(self, secType):
+        """(name, value, size, type) of the symbols in the sections of secType"""
+        for section in self._sections:
+            if section[1] != secType or section[5] >= len(self._sections):
+                continue
+            strtab = self._sections[section[5]][3]
+            for pos in range(section[3], section[3] + section[4] - self._sym.size + 1, self._sym.size):
+                fields = self._sym.unpack_from(self._data, pos)
+                if self._is64:
+                    nameOffset, info, _, shndx, value, size = fields
+                else:
+                    nameOffset, value, size, info, _, shndx = fields
+                if shndx == 0:
+                    # undefined
+                    continue
+                yield self._string(strtab, nameOffset), value, size, info & 0xf
+
+    def build_id(self):
+        """hex GNU build-id, None if there is none"""
+        for section in self._sections:
+            if section[1] != _ElfSymbols.SHT_NOTE or self._section_name(section) != '.note.gnu.build-id':
+                continue
+            nameSize, descSize, noteType = struct.unpack_from(self._order + 'III', self._data, section[3])
+            if noteType != _ElfSymbols.NT_GNU_BUILD_ID:
+                continue
+            descStart = section[3] + 12 + (nameSize + 3) // 4 * 4
+            return binascii.hexlify(self._data[descStart:descStart + descSize]).decode('ascii')
+        return None
+ 
+class _Symbolizer(object):
+    """symbolize frames of one object file: function names from its ELF symbol table,
+    file:line with one addr2line process and demangling with one c++filt process,
+    results are cached per address and per mangled name"""
+
+    BATCH_SIZE = 256
+
+    def __init__(self, object_file, cacheDir=None):
+        """object_file None for demangling only, nothing is resolved"""
+        self._objFile = object_file
+        self._symbols = _ElfSymbols.load(object_file, cacheDir) if object_file else None
+        self._addr2line = None
+        self._cxxfilt = None
+        self._lineCache = {}
+        self._nameCache = {}
+
+    def functions(self, addrs, frames):
+        """(function, offset) of every address relative to the load base from the symbol
+        table, those of the frame (addr, func, offset) if the address is None, because
+        the load base is unknown, or is in no function"""
+        funcs = []
+        for addr, (_, func, offset) in zip(addrs, frames):
+            symbol = self._symbols.lookup(addr) if self._symbols is not None and addr is not None else None
+            funcs.append(symbol if symbol else (func, offset))
+        return funcs
+
+    def adjust(self, frames, base=None):
+        """addresses of the frames (addr, func, offset) relative to the load base, None
+        where it can't be told, base is the last one known. returns the addresses and
+        the last base known"""
+        addrs = []
+        for addr, func, offset in frames:
+            frameBase = self.load_base(addr, func, offset)
+            if frameBase is not None:
+                base = frameBase
+            addrs.append(addr - base if base is not None and addr >= base else None)
+        return addrs, base
+
+    def load_base(self, addr, func, offset):
+        """address the object was loaded at, told by a frame printed as func+offset
+        at addr, None if it can't be told"""
+        if self._symbols is None:
+            return None
+        if not self._symbols.relocatable:
+            return 0
+        if offset is None:
+            return None
+        if not func:
+            # glibc prints the offset from the load base when there is no symbol
+            return addr - offset
+        funcAddr = self._symbols.address(func)
+        if funcAddr is None:
+            return None
+        return addr - funcAddr - offset
+
+    def _lookup(self, keys, cache, proc):
+        missing = [k for k in set(keys) if k not in cache]
+        if missing:
+            for key, value in zip(missing, proc.query(missing)):
+                cache[key] = value
+        return [cache[k] for k in keys]
+
+    def labels(self, funcs):
+        """demangled function+0xoffset of (function, offset) pairs"""
+        names = self.demangle([f[0] for f in funcs])
+        return ['{}+0x{:x}'.format(name, f[1]) if name and f[1] is not None else name
+                for name, f in zip(names, funcs)]
+
+    def demangle(self, names):
+        """demangled function names, empty names stay empty"""
+        if self._cxxfilt is None:
+            self._cxxfilt = _CoProcess(['c++filt'])
+        self._nameCache[''] = ''
+        return self._lookup(names, self._nameCache, self._cxxfilt)
+
+    def addr2line(self, addrs):
+        """file:line of every address"""
+        if self._objFile is None:
+            return ['??:0'] * len(addrs)
+        if self._addr2line is None:
+            self._addr2line = _CoProcess(['addr2line', '-e', self._objFile])
+        return self._lookup(addrs, self._lineCache, self._addr2line)
+
+    def close(self):
+        for proc in (self._addr2line, self._cxxfilt):
+            if proc is not None:
+                proc.close()
+        self._addr2line = self._cxxfilt = None
+ 
+class _ModuleSymbolizers(object):
+    """symbolize frames against their own module path, the addresses are adjusted for
+    the load base of the module. keeps an LRU of per-object symbolizers and demangles
+    with one c++filt for all of them"""
+
+    def __init__(self, maxObjects, cacheDir=None, fileLines=True, loadBases=None):
+        self._maxObjects = maxObjects
+        self._cacheDir = cacheDir
+        self._fileLines = fileLines
+        self._symbolizers = collections.OrderedDict()
+        self._demangler = _Symbolizer(None)
+        # realpath => load base, from a maps file or the last frame telling it
+        self._bases = dict(loadBases or {})
+
+    def _get(self, path):
+        symbolizer = self._symbolizers.pop(path, None)
+        if symbolizer is None:
+            symbolizer = _Symbolizer(path if os.path.isfile(path) else None, self._cacheDir)
+            while len(self._symbolizers) >= self._maxObjects:
+                self._symbolizers.popitem(last=False)[1].close()
+        self._symbolizers[path] = symbolizer
+        return symbolizer
+
+    def symbolize(self, path, frames):
+        """(file:line, function) of the frames (addr, func, offset) of the module path"""
+        path = os.path.realpath(path)
+        symbolizer = self._get(path)
+        addrs, base = symbolizer.adjust(frames, self._bases.get(path))
+        if base is not None:
+            self._bases[path] = base
+        funcs = self._demangler.labels(symbolizer.functions(addrs, frames))
+        # the runtime address is the best guess left for file:line
+        addrs = ['0x{:x}'.format(addr if addr is not None else frame[0]) for addr, frame in zip(addrs, frames)]
+        fileLines = symbolizer.addr2line(addrs) if self._fileLines else addrs
+        return list(zip(fileLines, funcs))
+
+    def close(self):
+        for symbolizer in self._symbolizers.values():
+            symbolizer.close()
+        self._symbolizers.clear()
+        self._demangler.close()
+ 
+def _module_worker(conn, maxObjects, cacheDir, fileLines, loadBases):
+    """worker process, symbolizes [(path, frames), ...] lists until None is received"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    symbolizers = _ModuleSymbolizers(maxObjects, cacheDir, fileLines, loadBases)
+    try:
+        while True:
+            tasks = conn.recv()
+            if tasks is None:
+                break
+            conn.send([symbolizers.symbolize(path, frames) for path, frames in tasks])
+    finally:
+        symbolizers.close()
+ 
+def _read_load_bases(mapsFile):
+    """realpath => load base from a /proc/<pid>/maps copy"""
+    bases = {}
+    with open(mapsFile) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 6 or not fields[5].startswith('/'):
+                continue
+            start = int(fields[0].split('-')[0], 16)
+            offset = int(fields[2], 16)
+            path = os.path.realpath(fields[5])
+            # the lowest mapping of the object tells its base
+            if path not in bases or start - offset < bases[path]:
+                bases[path] = start - offset
+    return bases
+ 
+def _iter_line_batches(stream, batchSize):
+    """yield lists of lines, a batch ends when full or when no more input is ready yet,
+    so that a live log is not held back"""
+    batch = []
+    while True:
+        line = stream.readline()
+        if not line:
+            break
+        batch.append(line)
+        if len(batch) >= batchSize or not select.select([stream], [], [], 0)[0]:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+ 
+def _parse_frames(lines):
+    """(path, addr, func, offset or None) of the backtrace lines"""
+    frames = []
+    for line in lines:
         match = _bt_line_regex.match(line)
         if not match:
             continue
         groups = match.groupdict()
-        path = groups['path']
-        func = groups['func']
-        addr = groups['addr']
-        # demangle function name
-        func = _run_cmd('c++filt {}'.format(func)).strip()
-        # translate return address to file path and line number
-        addr = _run_cmd('addr2line -e {} {}'.format(object_file, addr)).strip()
-        print('[{}]  {}  {}'.format(path, addr, func))
+        offset = int(groups['offset'][1:], 16) if groups['offset'] else None
+        frames.append((groups['path'], int(groups['addr'], 16), groups['func'], offset))
+    return frames
+ 
+def main_modules(jobs=1, maxObjects=16, fileLines=True, cacheDir=None, loadBases=None):
+    """symbolize every frame with its own module path, distinct objects are spread over
+    jobs worker processes, the output keeps the input order"""
+    workers = []
+    local = None
+    if jobs > 1:
+        for _ in range(jobs):
+            conn, childConn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_module_worker,
+                args=(childConn, maxObjects, cacheDir, fileLines, loadBases))
+            proc.daemon = True
+            proc.start()
+            workers.append((proc, conn))
+    else:
+        local = _ModuleSymbolizers(maxObjects, cacheDir, fileLines, loadBases)
+    assigned = {} # module path => worker index
+    try:
+        for lines in _iter_line_batches(sys.stdin, _Symbolizer.BATCH_SIZE):
+            frames = _parse_frames(lines)
+            modules = collections.OrderedDict() # path => frame indexes
+            for i, frame in enumerate(frames):
+                modules.setdefault(frame[0], []).append(i)
+            results = [None] * len(frames)
+            if local is not None:
+                for path, indexes in modules.items():
+                    for i, result in zip(indexes, local.symbolize(path, [frames[i][1:] for i in indexes])):
+                        results[i] = result
+            else:
+                # one message per worker, the objects of a batch are symbolized in parallel
+                tasks = [[] for _ in workers]
+                for path, indexes in modules.items():
+                    w = assigned.setdefault(path, len(assigned) % len(workers))
+                    tasks[w].append((path, indexes))
+                for w, task in enumerate(tasks):
+                    if task:
+                        workers[w][1].send([(path, [frames[i][1:] for i in indexes]) for path, indexes in task])
+                for w, task in enumerate(tasks):
+                    if task:
+                        for (path, indexes), moduleResults in zip(task, workers[w][1].recv()):
+                            for i, result in zip(indexes, moduleResults):
+                                results[i] = result
+            for frame, (fileLine, func) in zip(frames, results):
+                print('[{}]  {}  {}'.format(frame[0], fileLine, func))
+            sys.stdout.flush()
+    finally:
+        if local is not None:
+            local.close()
+        for proc, conn in workers:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+        for proc, conn in workers:
+            proc.join(5)
+            if proc.is_alive():
+                proc.terminate()
     return 0
  
-def usage():
-    return'usage: python {} <object_file>'.format(sys.argv[0])
+def main(object_file, fileLines=True, cacheDir=None):
+    symbolizer = _Symbolizer(object_file, cacheDir)
+    objName = os.path.basename(object_file)
+    base = None
+    try:
+        for lines in _iter_line_batches(sys.stdin, _Symbolizer.BATCH_SIZE):
+            # extract function name, offset and return address
+            # from backtrace's output
+            frames = _parse_frames(lines)
+            # resolve function names from the symbol table, for the frames of the
+            # object file only, relative to its load base, and translate return
+            # addresses to file path and line number, a whole batch at once
+            own = [i for i, f in enumerate(frames) if os.path.basename(f[0]) == objName]
+            funcs = [f[2:] for f in frames]
+            addrs = [f[1] for f in frames]
+            ownAddrs, base = symbolizer.adjust([frames[i][1:] for i in own], base)
+            ownFuncs = symbolizer.functions(ownAddrs, [frames[i][1:] for i in own])
+            for i, addr, func in zip(own, ownAddrs, ownFuncs):
+                funcs[i] = func
+                if addr is not None:
+                    addrs[i] = addr
+            funcs = symbolizer.labels(funcs)
+            addrs = ['0x{:x}'.format(addr) for addr in addrs]
+            if fileLines:
+                addrs = symbolizer.addr2line(addrs)
+            for frame, addr, func in zip(frames, addrs, funcs):
+                print('[{}]  {}  {}'.format(frame[0], addr, func))
+            sys.stdout.flush()
+    finally:
+        symbolizer.close()
+    return 0
  
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print(usage())
-        sys.exit(2)
-    objFile = sys.argv[1]
+    argParser = argparse.ArgumentParser(description='symbolize backtrace output read from stdin')
+    argParser.add_argument('object_file', nargs='?', help='object file the addresses belong to, not used with -m')
+    argParser.add_argument('-n', '--no-lines', dest='lines', action='store_false', default=True,
+        help='do not run addr2line for file:line, print the addresses instead')
+    argParser.add_argument('--cache-dir', default=os.path.join(os.path.expanduser('~'), '.cache', 'backtrace_parser'),
+        help='directory of the symbol table caches, empty to disable, default %(default)s')
+    argParser.add_argument('-m', '--modules', action='store_true', default=False,
+        help='symbolize every frame with its own module path, adjusted for its load base')
+    argParser.add_argument('-j', '--jobs', type=int, default=1,
+        help='worker processes for -m, distinct objects are spread over them, default %(default)s')
+    argParser.add_argument('--max-objects', type=int, default=16,
+        help='object files kept open per process for -m, default %(default)s')
+    argParser.add_argument('--maps', help='copy of /proc/<pid>/maps of the crashed process, load bases for -m')
+    args = argParser.parse_args()
+    objFile = args.object_file
+ 
+    if args.modules:
+        if args.jobs < 1 or args.max_objects < 1:
+            argParser.error('invalid number of jobs or objects')
+        loadBases = _read_load_bases(args.maps) if args.maps else None
+        sys.exit(main_modules(args.jobs, args.max_objects, args.lines, args.cache_dir, loadBases))
+    if not objFile:
+        argParser.error('object_file is required without -m')
  
     if not os.path.exists(objFile):
         print('object file does not exists: {}'.format(objFile))
         sys.exit(2)
-    sys.exit(main(objFile))
+    sys.exit(main(objFile, args.lines, args.cache_dir))
@@ -5,8 +5,13 @@
 # @brief: use python to parse binary file
 # @depend: construct
 #          structs_little_endian.py or structs_big_endian.py
+#          numpy (optional, decodes arrays of fixed-size records faster)
 
-import os, sys, struct, codecs, inspect, binascii, optparse, construct
+import os, sys, mmap, time, array, signal, struct, codecs, inspect, binascii, optparse, cStringIO, multiprocessing, construct
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def write_dict(fdWriter, dictObj):
     fdWriter.write("{")
@@ -22,7 +27,453 @@ ProtobufMap = {
     "proto.News": [1,20],
 }
 
+# writes a protobuf pack:
+# crc32 checksum, protobuf-name-size, protobuf-name, count, proto-data-size, proto-data, ...
+# data is collected as a list of chunks and joined once, the crc32 is updated chunk by chunk.
+# with outFile the chunks are written to it every FLUSH_SIZE bytes, outFile must be seekable
+# since the crc32 (and counts not known in advance) are written at the end
+class ProtobufPackWriter(object):
+    FLUSH_SIZE = 1 << 20
+
+    def __init__(self, protoFullName, outFile=None):
+        self.out_file = outFile
+        self.chunks = []
+        self.chunks_size = 0
+        self.crc = 0
+        self.count_index = None # chunk index of a count not known yet, or its file position once flushed
+        self.count_pos = None
+        self.count = 0
+        self.recalc_crc = False
+        if self.out_file is not None:
+            self.start_pos = self.out_file.tell()
+            self.out_file.write(struct.pack("<i", 0))
+        self._append(struct.pack("<i", len(protoFullName)) + struct.pack("{}s".format(len(protoFullName)), protoFullName))
+
+    def _append(self, data):
+        self.chunks.append(data)
+        self.chunks_size += len(data)
+        if self.out_file is not None and self.chunks_size >= self.FLUSH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self.count_index is not None:
+            self.count_pos = self.out_file.tell() + sum(len(c) for c in self.chunks[:self.count_index])
+            self.count_index = None
+            # the crc32 goes over the placeholder now
+            self.recalc_crc = True
+        data = "".join(self.chunks)
+        self.out_file.write(data)
+        self.crc = binascii.crc32(data, self.crc)
+        self.chunks = []
+        self.chunks_size = 0
+
+    # start the records of a body field, count None if not known yet
+    def begin_records(self, count=None):
+        self._end_records()
+        if count is None:
+            self.count_index = len(self.chunks)
+            self.count = 0
+        self._append(struct.pack("<i", count or 0))
+
+    def _end_records(self):
+        if self.count_index is not None:
+            self.chunks[self.count_index] = struct.pack("<i", self.count)
+            self.count_index = None
+        elif self.count_pos is not None:
+            pos = self.out_file.tell()
+            self.out_file.seek(self.count_pos)
+            self.out_file.write(struct.pack("<i", self.count))
+            self.out_file.seek(pos)
+            self.count_pos = None
+
+    def add_record(self, protoBinStr):
+        self.count += 1
+        self._append(struct.pack("<i", len(protoBinStr)))
+        self._append(protoBinStr)
+
+    def add_proto(self, proto):
+        self.add_record(proto.SerializeToString())
+
+    # return the whole pack, or None when written to outFile
+    def close(self):
+        self._end_records()
+        if self.out_file is None:
+            data = "".join(self.chunks)
+            return struct.pack("<i", binascii.crc32(data, self.crc)) + data
+
+        self._flush()
+        endPos = self.out_file.tell()
+        if self.recalc_crc:
+            self.out_file.flush()
+            self.out_file.seek(self.start_pos + 4)
+            self.crc = 0
+            left = endPos - self.start_pos - 4
+            while left > 0:
+                data = self.out_file.read(min(left, self.FLUSH_SIZE))
+                self.crc = binascii.crc32(data, self.crc)
+                left -= len(data)
+        self.out_file.seek(self.start_pos)
+        self.out_file.write(struct.pack("<i", self.crc))
+        self.out_file.seek(endPos)
+        return None
+
+# random access to a protobuf pack written by ProtobufPackWriter. the pack is memory mapped,
+# its crc32 verified chunk by chunk, and the offsets of all the records are indexed, the
+# index is saved to (and next time loaded from) the sidecar file <pack>.idx.
+# record(i) is a zero-copy buffer over the mapped pack, the protobufs are only decoded when
+# asked for, with the class registered in ProtobufMap for the pack name:
+#   reader = ProtobufPackReader("x.pack", "proto")
+#   if reader.open():
+#       print(len(reader), reader[0], reader.record(1)[:])
+class ProtobufPackReader(object):
+    CRC_CHUNK = 1 << 20
+    INDEX_MAGIC = "PBPACKIDX1"
+    INDEX_HEAD = struct.Struct("<10sqiiqq") # magic, pack size, crc32, offset size, groups, records
+    INT32 = struct.Struct("<i")
+
+    def __init__(self, packFile, protoDir=None, indexFile=None, verify=True, saveIndex=True):
+        self.pack_file = packFile
+        self.proto_dir = protoDir
+        self.index_file = indexFile or "{}.idx".format(packFile)
+        self.verify = verify
+        self.save_index = saveIndex
+        self.mmap = None
+        self.name = None # protobuf pkg.class
+        self.crc = None
+        self.groups = None # (first record, count) of every body field
+        self.offsets = None # offset of every record data size
+        self.proto_cls = None
+
+    # return False on error
+    def open(self):
+        with open(self.pack_file, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < 8:
+                print("ERROR: {} is not a protobuf pack, size {}".format(self.pack_file, size))
+                return False
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = size
+        self.crc = self.INT32.unpack_from(self.mmap, 0)[0]
+        nameSize = self.INT32.unpack_from(self.mmap, 4)[0]
+        if nameSize < 0 or 8 + nameSize > size:
+            print("ERROR: {} is not a protobuf pack, protobuf name size {}".format(self.pack_file, nameSize))
+            return self._close_on_error()
+        self.name = self.mmap[8:8 + nameSize]
+        self.body_pos = 8 + nameSize
+
+        if self.verify and not self._verify_crc():
+            return self._close_on_error()
+        if not self._load_index():
+            if not self._build_index():
+                return self._close_on_error()
+            if self.save_index:
+                self._save_index()
+        return True
+
+    def _close_on_error(self):
+        self.close()
+        return False
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def _verify_crc(self):
+        crc = 0
+        for pos in xrange(4, self.size, self.CRC_CHUNK):
+            crc = binascii.crc32(buffer(self.mmap, pos, self.CRC_CHUNK), crc)
+        if crc & 0xffffffff != self.crc & 0xffffffff:
+            print("ERROR: crc32 mismatch in {}: {:08x} expected {:08x}".format(
+                self.pack_file, crc & 0xffffffff, self.crc & 0xffffffff))
+            return False
+        return True
+
+    def _build_index(self):
+        unpack = self.INT32.unpack_from
+        mm, size = self.mmap, self.size
+        groups = []
+        offsets = array.array("l")
+        pos = self.body_pos
+        while pos < size:
+            if pos + 4 > size:
+                print("ERROR: {} is truncated at {}".format(self.pack_file, pos))
+                return False
+            count = unpack(mm, pos)[0]
+            pos += 4
+            if count < 0:
+                print("ERROR: invalid record count {} in {} at {}".format(count, self.pack_file, pos - 4))
+                return False
+            groups.append((len(offsets), count))
+            for x in xrange(count):
+                if pos + 4 > size:
+                    print("ERROR: {} is truncated at {}".format(self.pack_file, pos))
+                    return False
+                dataSize = unpack(mm, pos)[0]
+                if dataSize < 0:
+                    print("ERROR: invalid record size {} in {} at {}".format(dataSize, self.pack_file, pos))
+                    return False
+                offsets.append(pos)
+                pos += 4 + dataSize
+            if pos > size:
+                print("ERROR: {} is truncated at {}".format(self.pack_file, pos))
+                return False
+        self.groups = groups
+        self.offsets = offsets
+        return True
+
+    # the index is only used when made for a pack of the same size and crc32
+    def _load_index(self):
+        if not os.path.isfile(self.index_file):
+            return False
+        offsets = array.array("l")
+        groupArray = array.array("l")
+        with open(self.index_file, "rb") as f:
+            head = f.read(self.INDEX_HEAD.size)
+            if len(head) != self.INDEX_HEAD.size:
+                return False
+            magic, packSize, crc, offsetSize, numGroups, numRecords = self.INDEX_HEAD.unpack(head)
+            if magic != self.INDEX_MAGIC or packSize != self.size or crc != self.crc or offsetSize != offsets.itemsize:
+                return False
+            try:
+                groupArray.fromfile(f, numGroups * 2)
+                offsets.fromfile(f, numRecords)
+            except EOFError:
+                return False
+        self.groups = zip(groupArray[::2], groupArray[1::2])
+        self.offsets = offsets
+        return True
+
+    def _save_index(self):
+        groupArray = array.array("l")
+        for first, count in self.groups:
+            groupArray.extend((first, count))
+        tmpFile = "{}.{}.tmp".format(self.index_file, os.getpid())
+        try:
+            with open(tmpFile, "wb") as f:
+                f.write(self.INDEX_HEAD.pack(self.INDEX_MAGIC, self.size, self.crc,
+                    self.offsets.itemsize, len(self.groups), len(self.offsets)))
+                groupArray.tofile(f)
+                self.offsets.tofile(f)
+            os.rename(tmpFile, self.index_file)
+        except (IOError, OSError) as e:
+            # the index is only a cache, the pack is still readable
+            print("WARNING: can't save the index {}: {}".format(self.index_file, e))
+            if os.path.isfile(tmpFile):
+                os.remove(tmpFile)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # the data of record i, a zero-copy buffer over the pack
+    def record(self, i):
+        pos = self.offsets[i]
+        return buffer(self.mmap, pos + 4, self.INT32.unpack_from(self.mmap, pos)[0])
+
+    def records(self, start=0, stop=None):
+        for i in xrange(*slice(start, stop).indices(len(self.offsets))):
+            yield self.record(i)
+
+    def _get_proto_cls(self):
+        if self.proto_cls is None:
+            if self.name not in ProtobufMap:
+                print("ERROR: {} not registered in ProtobufMap".format(self.name))
+                return None
+            if self.proto_dir and self.proto_dir not in sys.path:
+                sys.path.append(self.proto_dir)
+            protoClsName = self.name.split(".")[-1]
+            protoFileName = "{}_pb2".format(protoClsName)
+            __import__(protoFileName)
+            self.proto_cls = getattr(sys.modules[protoFileName], protoClsName)
+        return self.proto_cls
+
+    # record i decoded as a protobuf, None if the protobuf class is unknown
+    def proto(self, i):
+        protoCls = self._get_proto_cls()
+        if protoCls is None:
+            return None
+        proto = protoCls()
+        proto.ParseFromString(self.record(i))
+        return proto
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.proto(x) for x in xrange(*i.indices(len(self.offsets)))]
+        return self.proto(i)
+
+    def __iter__(self):
+        for i in xrange(len(self.offsets)):
+            yield self.proto(i)
+
+# decodes the records of a construct.Struct made only of fixed-size fields: numbers of one
+# byte order, strings padded with "\0" on the right and unstrict padding. a batch of records
+# is decoded by one numpy.frombuffer call, or by a precompiled struct.Struct without numpy.
+# compile() returns None for any other struct (variable-length, nested, adapters, ...),
+# those are left to construct. the decoded records equal the ones construct parses
+class FixedStructDecoder(object):
+    # struct format char => numpy type of the same standard size
+    NUMPY_TYPES = {"b": "i1", "B": "u1", "h": "i2", "H": "u2", "i": "i4", "I": "u4", "l": "i4", "L": "u4",
+            "q": "i8", "Q": "u8", "f": "f4", "d": "f8"}
+
+    def __init__(self, names, numpyTypes, offsets, structFormat, size):
+        self.names = names
+        self.numpy_types = numpyTypes
+        self.size = size
+        self.packer = struct.Struct(structFormat)
+        self.string_indexes = [x for x in xrange(len(names)) if numpyTypes[x].startswith("S")]
+        self.dtype = None
+        if numpy is not None:
+            self.dtype = numpy.dtype({"names": names, "formats": numpyTypes, "offsets": offsets, "itemsize": size})
+
+    @classmethod
+    def compile(cls, structCon):
+        if not isinstance(structCon, construct.Struct):
+            return None
+        names, numpyTypes, offsets = [], [], []
+        endianity = None
+        structFormat = ""
+        size = 0
+        for sc in structCon.subcons:
+            if sc.conflags & sc.FLAG_EMBED:
+                return None
+            if isinstance(sc, construct.FormatField):
+                fieldEndianity, fmt = sc.packer.format[0], sc.packer.format[1:]
+                length = sc.packer.size
+                if fmt not in cls.NUMPY_TYPES:
+                    return None
+                if length > 1:
+                    if endianity not in (None, fieldEndianity):
+                        return None
+                    endianity = fieldEndianity
+                numpyType = fieldEndianity + cls.NUMPY_TYPES[fmt]
+            elif (isinstance(sc, construct.PaddedStringAdapter) and sc.padchar == "\0" and sc.paddir == "right"
+                    and type(sc.subcon) == construct.StringAdapter and sc.subcon.encoding is None
+                    and type(sc.subcon.subcon) == construct.StaticField):
+                length = sc.subcon.subcon.length
+                fmt = "{}s".format(length)
+                numpyType = "S{}".format(length)
+            elif (type(sc) == construct.PaddingAdapter and not sc.strict
+                    and type(sc.subcon) == construct.StaticField):
+                length = sc.subcon.length
+                fmt = "{}x".format(length)
+                numpyType = None
+            else:
+                return None
+
+            if numpyType is not None and sc.name is not None:
+                if sc.name in names:
+                    return None
+                names.append(sc.name)
+                numpyTypes.append(numpyType)
+                offsets.append(size)
+            elif not fmt.endswith("x"):
+                fmt = "{}x".format(length)
+            structFormat += fmt
+            size += length
+
+        if not names:
+            return None
+        return cls(names, numpyTypes, offsets, (endianity or "<") + structFormat, size)
+
+    # decode count records from data (str, mmap or any buffer), return a list of construct.Container
+    def decode(self, data, count, offset=0):
+        if self.dtype is not None:
+            records = numpy.frombuffer(data, self.dtype, count, offset)
+            columns = []
+            for x in xrange(len(self.names)):
+                column = records[self.names[x]]
+                if self.numpy_types[x][1:] == "u4":
+                    # numpy returns long for these, construct (struct) returns int
+                    columns.append(column.astype(numpy.int64).tolist())
+                elif self.numpy_types[x][1:] == "u8":
+                    columns.append([int(v) for v in column.tolist()])
+                else:
+                    columns.append(column.tolist())
+            rows = zip(*columns)
+        else:
+            unpack = self.packer.unpack_from
+            rows = [unpack(data, offset + x * self.size) for x in xrange(count)]
+            if self.string_indexes:
+                rows = [list(row) for row in rows]
+                for row in rows:
+                    for x in self.string_indexes:
+                        row[x] = row[x].rstrip("\0")
+
+        names = self.names
+        result = []
+        for row in rows:
+            # like Container.update, without going through Container.__setitem__ for every field
+            obj = construct.Container()
+            dict.update(obj, zip(names, row))
+            obj.__keys_order__.extend(names)
+            result.append(obj)
+        return result
+
+def _unicode_to_str(value):
+    return str(value) if type(value) == unicode else value
+
+def _extend_field(proto, name, values):
+    getattr(proto, name).extend(values)
+
+# conversion plan of a protobuf class, built once per class: the fields of the message
+# with the converter and setter of each, so that converting a record dict is a single
+# loop over them without any lookup or descriptor walk
+class ProtobufPlan(object):
+    def __init__(self, protoCls):
+        self.proto_cls = protoCls
+        self.fields = [] # (field name, converter or None, setter)
+        for fieldDesc in protoCls.DESCRIPTOR.fields:
+            if fieldDesc.label == fieldDesc.LABEL_REPEATED:
+                self.fields.append((fieldDesc.name, None, _extend_field))
+            elif fieldDesc.type in (fieldDesc.TYPE_STRING, fieldDesc.TYPE_BYTES):
+                self.fields.append((fieldDesc.name, _unicode_to_str, setattr))
+            else:
+                self.fields.append((fieldDesc.name, None, setattr))
+
+    def to_proto(self, dictObj):
+        proto = self.proto_cls()
+        for field, convert, setter in self.fields:
+            if field in dictObj:
+                setter(proto, field, dictObj[field] if convert is None else convert(dictObj[field]))
+        return proto
+
+    def to_bin(self, dictObj):
+        return self.to_proto(dictObj).SerializeToString()
+
+    # the batch versions, one tight loop over all the dicts
+    def to_proto_list(self, dictList):
+        protoCls = self.proto_cls
+        fields = self.fields
+        protoList = []
+        for dictObj in dictList:
+            proto = protoCls()
+            for field, convert, setter in fields:
+                if field in dictObj:
+                    setter(proto, field, dictObj[field] if convert is None else convert(dictObj[field]))
+            protoList.append(proto)
+        return protoList
+
+    def to_bin_list(self, dictList):
+        protoCls = self.proto_cls
+        fields = self.fields
+        protoBinList = []
+        for dictObj in dictList:
+            proto = protoCls()
+            for field, convert, setter in fields:
+                if field in dictObj:
+                    setter(proto, field, dictObj[field] if convert is None else convert(dictObj[field]))
+            protoBinList.append(proto.SerializeToString())
+        return protoBinList
+
 class BinaryFileParser(object):
+    FIXED_BATCH = 1 << 12 # fixed-size records decoded at once when streaming
+
     def __init__(self, protoDir, littleEndian=True):
         self.encoding = "GBK"
         self.script_path = os.path.dirname(inspect.getfile(inspect.currentframe()))
@@ -39,6 +490,8 @@ class BinaryFileParser(object):
         self.proto_dir = protoDir
         sys.path.append(self.proto_dir)
         self.protobuf_cls_map = {} # proto pkg.class => proto class object
+        self.protobuf_plan_map = {} # proto pkg.class => ProtobufPlan
+        self.fixed_decoders = {} # id of an array construct => FixedStructDecoder or None
 
     def _index_protobuf_map(self):
         for key, value in ProtobufMap.items():
@@ -52,11 +505,14 @@ class BinaryFileParser(object):
         protoClsName = protoPkgClsName.split(".")[-1]
         return ("{}_pb2".format(protoClsName), protoClsName)
 
-    def dict2protobuf(self, category, dictObj):
+    def _get_protobuf_plan(self, category):
         if not category in self.protobuf_map:
             print("ERROR: {} not in registered in ProtobufMap".format(category))
             return None
         protoPkgClsName = self.protobuf_map[category]
+        if protoPkgClsName in self.protobuf_plan_map:
+            return self.protobuf_plan_map[protoPkgClsName]
+
         if protoPkgClsName not in self.protobuf_cls_map:
             protoFileName, protoClsName = self._parse_proto_cls_name(protoPkgClsName)
             # the structs_{little|big}_endian.py should reside in the same directory
@@ -66,22 +522,29 @@ class BinaryFileParser(object):
         protoCls = self.protobuf_cls_map[protoPkgClsName]
         if not protoCls:
             return None
+        self.protobuf_plan_map[protoPkgClsName] = ProtobufPlan(protoCls)
+        return self.protobuf_plan_map[protoPkgClsName]
 
-        proto = protoCls()
-        for fieldDesc in proto.DESCRIPTOR.fields:
-            field = fieldDesc.name
-            if field in dictObj:
-                val = dictObj[field] if type(dictObj[field]) != unicode else str(dictObj[field])
-                setattr(proto, field, val)
-        return proto
+    def dict2protobuf(self, category, dictObj):
+        plan = self._get_protobuf_plan(category)
+        if plan is None:
+            return None
+        return plan.to_proto(dictObj)
 
     def generate_protobuf_list(self, category, listContainer):
-        protoList = []
-        for protoDict in listContainer:
-            protoList.append(self.dict2protobuf(category, protoDict))
-        return protoList
+        plan = self._get_protobuf_plan(category)
+        if plan is None:
+            return None
+        return plan.to_proto_list(listContainer)
 
-    def parse_binary_data(self, category, binInputData):
+    # same as generate_protobuf_list, with every protobuf serialized
+    def generate_protobuf_bin_list(self, category, listContainer):
+        plan = self._get_protobuf_plan(category)
+        if plan is None:
+            return None
+        return plan.to_bin_list(listContainer)
+
+    def _get_ret_struct(self, category):
         if int != type(category):
             print("ERROR: category should be a number: {}".format(category))
             return None
@@ -91,21 +554,153 @@ class BinaryFileParser(object):
             print("ERROR: the return struct {} was not declared".format(retStructName))
             return None
 
-        retStruct = getattr(sys.modules[self.structs_module], retStructName)
-        return retStruct.parse(binInputData)
+        return getattr(sys.modules[self.structs_module], retStructName)
+
+    def parse_binary_data(self, category, binInputData):
+        retStruct = self._get_ret_struct(category)
+        if retStruct is None:
+            return None
+        if not isinstance(retStruct, construct.Struct) or \
+                not any(self._get_fixed_decoder(sc) for sc in retStruct.subcons):
+            return retStruct.parse(binInputData)
+
+        # like construct.Struct._parse, with the arrays of fixed-size records decoded at once
+        stream = cStringIO.StringIO(binInputData)
+        obj = construct.Container()
+        context = construct.Container()
+        if retStruct.nested:
+            context = construct.Container(_ = context)
+        for sc in retStruct.subcons:
+            if sc.conflags & sc.FLAG_EMBED:
+                context["<obj>"] = obj
+                sc._parse(stream, context)
+                continue
+            decoder = self._get_fixed_decoder(sc)
+            count = self._get_fixed_count(sc, decoder, stream, context)
+            if count is None:
+                subobj = sc._parse(stream, context)
+            else:
+                subobj = construct.ListContainer(decoder.decode(stream.read(count * decoder.size), count))
+            if sc.name is not None:
+                if sc.name in obj and not retStruct.allow_overwrite:
+                    raise construct.OverwriteError("{!r} would be overwritten but allow_overwrite is False".format(sc.name))
+                obj[sc.name] = subobj
+                context[sc.name] = subobj
+        return obj
+
+    # the decoder of an array (construct.MetaArray or construct.Range) of fixed-size structs,
+    # None for anything else
+    def _get_fixed_decoder(self, sc):
+        if not isinstance(sc, (construct.MetaArray, construct.Range)):
+            return None
+        if id(sc) not in self.fixed_decoders:
+            self.fixed_decoders[id(sc)] = FixedStructDecoder.compile(sc.subcon)
+        return self.fixed_decoders[id(sc)]
+
+    # the number of records the array sc holds at the stream position, None when it can't be
+    # decoded by decoder: let construct parse it, and raise its error on short data
+    def _get_fixed_count(self, sc, decoder, stream, context):
+        if decoder is None:
+            return None
+        pos = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        left = (stream.tell() - pos) // decoder.size
+        stream.seek(pos)
+        if isinstance(sc, construct.MetaArray):
+            count = sc.countfunc(context)
+            return count if count <= left else None
+        # construct.Range, fixed-size records only fail at the end of data
+        count = min(sc.maxcout, left)
+        return count if count >= sc.mincount else None
+
+    # parse binary data from a stream (file, mmap) field by field, like construct.Struct._parse,
+    # and yield:
+    # ("head", name, value) for every top level field not registered in ProtobufMap
+    # ("count", name, count) before the records of a registered field, None if not known in advance
+    # ("record", name, container) for every record of a registered field
+    # records are not kept, so the fields after them can't refer to them
+    def iter_binary_records(self, category, stream):
+        retStruct = self._get_ret_struct(category)
+        if retStruct is None:
+            return
+        if not isinstance(retStruct, construct.Struct):
+            print("ERROR: the return struct of {} is not a construct.Struct".format(category))
+            return
+
+        obj = construct.Container()
+        context = construct.Container()
+        if retStruct.nested:
+            context = construct.Container(_ = context)
+        for sc in retStruct.subcons:
+            if sc.conflags & sc.FLAG_EMBED:
+                # embedded struct, its fields go into obj directly
+                keys = obj.keys()
+                context["<obj>"] = obj
+                sc._parse(stream, context)
+                for k in obj.keys():
+                    if k not in keys:
+                        yield ("head", k, obj[k])
+            elif sc.name in ProtobufMap:
+                for item in self._iter_body_records(sc, stream, context):
+                    yield item
+            else:
+                subobj = sc._parse(stream, context)
+                if sc.name is not None:
+                    obj[sc.name] = subobj
+                    context[sc.name] = subobj
+                    yield ("head", sc.name, subobj)
+
+    def _iter_body_records(self, sc, stream, context):
+        if not isinstance(sc, (construct.MetaArray, construct.Range)):
+            yield ("count", sc.name, 1)
+            yield ("record", sc.name, sc._parse(stream, context))
+            return
+
+        decoder = self._get_fixed_decoder(sc)
+        count = self._get_fixed_count(sc, decoder, stream, context)
+        if count is not None:
+            yield ("count", sc.name, count)
+            while count > 0:
+                batch = min(count, self.FIXED_BATCH)
+                for record in decoder.decode(stream.read(batch * decoder.size), batch):
+                    yield ("record", sc.name, record)
+                count -= batch
+            return
+
+        copyContext = sc.subcon.conflags & sc.FLAG_COPY_CONTEXT
+        if isinstance(sc, construct.MetaArray):
+            count = sc.countfunc(context)
+            yield ("count", sc.name, count)
+            for x in xrange(count):
+                yield ("record", sc.name, sc.subcon._parse(stream, context.__copy__() if copyContext else context))
+            return
+
+        # construct.Range, parse until maxcount or the first failure
+        yield ("count", sc.name, None)
+        count = 0
+        while count < sc.maxcout:
+            pos = stream.tell()
+            try:
+                record = sc.subcon._parse(stream, context.__copy__() if copyContext else context)
+            except construct.ConstructError:
+                if count < sc.mincount:
+                    raise construct.RangeError("expected {} to {}, found {}".format(sc.mincount, sc.maxcout, count))
+                stream.seek(pos)
+                break
+            count += 1
+            yield ("record", sc.name, record)
 
     # parse binary data and return:
     # 1) head: json string
     # 2) body: generated protobuf as binary string, only support little-endian for now
     #          crc32 checksum, protobuf-name-size, protobuf-name, count, proto-data-size, proto-data, proto-data-size, proto-data, ...
-    def parse_binary_to_protobuf(self, category, binInputData):
+    #          or None when written to outFile, see ProtobufPackWriter
+    def parse_binary_to_protobuf(self, category, binInputData, outFile=None):
         if category not in self.protobuf_map:
             print("ERROR: {} not registered in ProtobufMap".format(category))
             return
 
-        protoFullName = self.protobuf_map[category]
-        result = struct.pack("<i", len(protoFullName))
-        result += struct.pack("{}s".format(len(protoFullName)), protoFullName)
+        writer = ProtobufPackWriter(self.protobuf_map[category], outFile)
         container = self.parse_binary_data(category, binInputData)
 
         jsonHead = {}
@@ -116,26 +711,156 @@ class BinaryFileParser(object):
                     jsonHead[k] = str(v)
             # parse body
             elif isinstance(v, list):
-                protoList = self.generate_protobuf_list(category, v)
-                # proto count
-                result += struct.pack("<i", len(protoList))
-                # proto data array
-                for proto in protoList:
-                    protoBinStr = proto.SerializeToString()
-                    result += struct.pack("<i", len(protoBinStr))
-                    result += protoBinStr
+                protoBinList = self.generate_protobuf_bin_list(category, v)
+                writer.begin_records(len(protoBinList))
+                for protoBinStr in protoBinList:
+                    writer.add_record(protoBinStr)
             else:
-                result += struct.pack("<i", 1)
-                proto = self.dict2protobuf(category, v)
-                protoBinStr = proto.SerializeToString()
-                result += len(protoBinStr)
-                result += protoBinStr
+                writer.begin_records(1)
+                writer.add_proto(self.dict2protobuf(category, v))
 
         #head = json.dumps(jsonHead, ensure_ascii=False)
         #head = str(jsonHead).replace("'", '"')
-        # calc crc32 and return
-        body = struct.pack("<i", binascii.crc32(result)) + result
-        return jsonHead, body
+        return jsonHead, writer.close()
+
+    # same as parse_binary_to_protobuf, but the input stream is parsed record by record
+    # and every packed protobuf is written to outFile right away, the body is never held
+    # in memory. outFile must be seekable, see ProtobufPackWriter
+    # return the head, or None on error
+    def parse_binary_to_protobuf_file(self, category, stream, outFile):
+        if category not in self.protobuf_map:
+            print("ERROR: {} not registered in ProtobufMap".format(category))
+            return None
+
+        plan = self._get_protobuf_plan(category)
+        writer = ProtobufPackWriter(self.protobuf_map[category], outFile)
+        jsonHead = {}
+        for kind, name, value in self.iter_binary_records(category, stream):
+            if kind == "record":
+                writer.add_record(plan.to_bin(value))
+            elif kind == "count":
+                writer.begin_records(value)
+            elif not isinstance(value, list):
+                jsonHead[name] = str(value)
+        writer.close()
+        return jsonHead
+
+# convert one data file, the body is written to the bodyFile protobuf pack,
+# with stream the data file is memory mapped, see parse_binary_to_protobuf_file
+# return the head, or None on error
+def convert_binary_file(parser, category, dataFile, bodyFile, stream=False):
+    with open(dataFile, "rb") as f:
+        if not stream:
+            with open(bodyFile, "w+b") as of:
+                result = parser.parse_binary_to_protobuf(category, f.read(), of)
+            return result[0] if result is not None else None
+
+        if os.path.getsize(dataFile) == 0:
+            print("ERROR: {} is empty".format(dataFile))
+            return None
+        binInput = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with open(bodyFile, "w+b") as of:
+                return parser.parse_binary_to_protobuf_file(category, binInput, of)
+        finally:
+            binInput.close()
+
+# batch mode: (data file, category) pairs from a directory or a manifest, converted by
+# a pool of processes, each of them keeps its BinaryFileParser (structs and protobuf
+# modules imported) for all the files it gets
+def load_batch_tasks(dataDir, manifest, category, outputDir):
+    pairs = []
+    if dataDir:
+        for name in sorted(os.listdir(dataDir)):
+            dataFile = os.path.join(dataDir, name)
+            if os.path.isfile(dataFile):
+                pairs.append((dataFile, category))
+    else:
+        # one "data-file category" pair per line, relative paths are relative to the manifest
+        baseDir = os.path.dirname(manifest)
+        with open(manifest) as f:
+            for lineNo, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                fields = line.rsplit(None, 1)
+                if len(fields) != 2 or not fields[1].isdigit():
+                    print("ERROR: {}:{}: expect a data file and a category: {}".format(manifest, lineNo, line))
+                    return None
+                pairs.append((os.path.join(baseDir, fields[0]), int(fields[1])))
+
+    tasks = []
+    outNames = set()
+    for dataFile, dataCategory in pairs:
+        name = os.path.basename(dataFile)
+        if name in outNames:
+            print("ERROR: duplicate data file name {}, outputs would overwrite each other".format(name))
+            return None
+        outNames.add(name)
+        tasks.append((dataFile, dataCategory,
+            os.path.join(outputDir, "{}.json".format(name)), os.path.join(outputDir, "{}.pack".format(name))))
+    return tasks
+
+batchWorker = None # (parser, stream) of a batch worker process
+
+def init_batch_worker(protoDir, littleEndian, stream):
+    global batchWorker
+    # ctrl-c is handled by the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    batchWorker = (BinaryFileParser(protoDir, littleEndian), stream)
+
+# return (data file, ok, data size, seconds)
+def convert_batch_file(task):
+    dataFile, category, headFile, bodyFile = task
+    parser, stream = batchWorker
+    startTime = time.time()
+    if not os.path.isfile(dataFile):
+        print("ERROR: {} is not a regular file".format(dataFile))
+        return (dataFile, False, 0, 0)
+    try:
+        jsonHead = convert_binary_file(parser, category, dataFile, bodyFile, stream)
+        if jsonHead is not None:
+            with open(headFile, "w") as of:
+                write_dict(of, jsonHead)
+    except Exception as e:
+        print("ERROR: failed to convert {}: {}: {}".format(dataFile, type(e).__name__, e))
+        jsonHead = None
+    if jsonHead is None:
+        # no partial outputs
+        for outFile in (headFile, bodyFile):
+            if os.path.isfile(outFile):
+                os.remove(outFile)
+    return (dataFile, jsonHead is not None, os.path.getsize(dataFile), time.time() - startTime)
+
+def run_batch(tasks, protoDir, littleEndian, stream, jobs):
+    # the biggest files first, so that no worker is left with a big one at the end
+    tasks.sort(key=lambda t: os.path.getsize(t[0]) if os.path.isfile(t[0]) else 0, reverse=True)
+    startTime = time.time()
+    pool = multiprocessing.Pool(jobs, init_batch_worker, (protoDir, littleEndian, stream))
+    numOk, numFailed, totalSize, busyTime = 0, 0, 0, 0
+    try:
+        for dataFile, ok, size, seconds in pool.imap_unordered(convert_batch_file, tasks):
+            if ok:
+                numOk += 1
+                totalSize += size
+                busyTime += seconds
+            else:
+                numFailed += 1
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        print("ERROR: interrupted")
+        raise
+    finally:
+        pool.join()
+
+    elapsed = max(time.time() - startTime, 1e-6)
+    megabytes = totalSize / 1048576.0
+    print("{} files converted, {} failed, {:.1f} MB in {:.2f}s with {} processes".format(
+        numOk, numFailed, megabytes, elapsed, jobs))
+    print("throughput: {:.1f} files/s, {:.2f} MB/s, {:.2f}s per file in a worker".format(
+        numOk / elapsed, megabytes / elapsed, busyTime / numOk if numOk else 0))
+    return numFailed == 0
 
 if __name__ == "__main__":
     cmdParser = optparse.OptionParser()
@@ -145,8 +870,41 @@ if __name__ == "__main__":
     cmdParser.add_option("-B", "--body", dest="body", help="Output body part to a protobuf pack file")
     cmdParser.add_option("-p", "--proto-dir", dest="protoDir", help="Directory which contains the generated python protobuf message class")
     cmdParser.add_option("-b", "--big-endian", dest="littleEndian", action="store_false", default=True, help="Use big endian, default little endian")
+    cmdParser.add_option("-s", "--stream", dest="stream", action="store_true", default=False,
+            help="Memory map the data file and write the protobuf records to the -B file one by one, for files larger than memory")
+    cmdParser.add_option("-d", "--dir", dest="dataDir", help="Batch mode: convert every file in this directory, all of the -c category")
+    cmdParser.add_option("-m", "--manifest", dest="manifest", help="Batch mode: convert the files listed in this manifest, a 'data-file category' pair per line")
+    cmdParser.add_option("-o", "--output-dir", dest="outputDir", help="Batch mode: directory of the head (<data-file>.json) and body (<data-file>.pack) outputs")
+    cmdParser.add_option("-j", "--jobs", type="int", dest="jobs", default=multiprocessing.cpu_count(),
+            help="Batch mode: number of worker processes, default the number of cpus")
     options, args = cmdParser.parse_args()
 
+    if options.dataDir or options.manifest:
+        if options.dataDir and options.manifest:
+            print("ERROR: use either a data directory or a manifest")
+            sys.exit(1)
+        if not options.protoDir or not options.outputDir or (options.dataDir and not options.category):
+            print("ERROR: no protobuf directory or no output directory or no category")
+            sys.exit(1)
+        if options.dataDir and not os.path.isdir(options.dataDir):
+            print("ERROR: {} is not a directory".format(options.dataDir))
+            sys.exit(1)
+        if options.manifest and not os.path.isfile(options.manifest):
+            print("ERROR: {} is not a regular file".format(options.manifest))
+            sys.exit(1)
+        if options.jobs < 1:
+            print("ERROR: invalid number of jobs: {}".format(options.jobs))
+            sys.exit(1)
+        if not os.path.isdir(options.outputDir):
+            os.makedirs(options.outputDir)
+
+        tasks = load_batch_tasks(options.dataDir, options.manifest, options.category, options.outputDir)
+        if tasks is None:
+            sys.exit(1)
+        if not run_batch(tasks, options.protoDir, options.littleEndian, options.stream, options.jobs):
+            sys.exit(1)
+        sys.exit(0)
+
     if not options.dataFile or not options.protoDir or not options.category:
         print("ERROR: no input data file or no protobuf directory or no category")
         sys.exit(1)
@@ -154,24 +912,28 @@ if __name__ == "__main__":
         print("ERROR: {} is not a regular file".format(options.dataFile))
         sys.exit(1)
 
-    parser = BinaryFileParser(options.protoDir, options.littleEndian)
-    with open(options.dataFile, "rb") as f:
-        binInputData = f.read()
-        jsonHead, binBody = parser.parse_binary_to_protobuf(options.category, binInputData)
+    if options.stream and not options.body:
+        print("ERROR: stream mode needs a body output file")
+        sys.exit(1)
 
-        if options.head:
-            with open(options.head, "w") as of:
-                write_dict(of, jsonHead)
-                #codecs.getwriter(parser.encoding)(of).write(jsonHead)
-                # remove double quotes in the beginning and end, and remove back slashes
-                #of.write(json.dumps(jsonHead).replace('\\', '').strip('"'))
-                #pprint.pprint(jsonHead, of)
-        else:
-            sys.stdout.write(jsonHead)
+    parser = BinaryFileParser(options.protoDir, options.littleEndian)
+    if options.body:
+        jsonHead = convert_binary_file(parser, options.category, options.dataFile, options.body, options.stream)
+        if jsonHead is None:
+            sys.exit(1)
+    else:
+        with open(options.dataFile, "rb") as f:
+            jsonHead, binBody = parser.parse_binary_to_protobuf(options.category, f.read())
 
-        if options.body:
-            with open(options.body, "wb") as of:
-                of.write(binBody)
-        else:
-            sys.stdout.write(binBody)
+    if options.head:
+        with open(options.head, "w") as of:
+            write_dict(of, jsonHead)
+            #codecs.getwriter(parser.encoding)(of).write(jsonHead)
+            # remove double quotes in the beginning and end, and remove back slashes
+            #of.write(json.dumps(jsonHead).replace('\\', '').strip('"'))
+            #pprint.pprint(jsonHead, of)
+    else:
+        sys.stdout.write(jsonHead)
 
+    if not options.body:
+        sys.stdout.write(binBody)
@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# @date: 2026-10-18
+# @desc: poor man's profiler in python, successor of pprofiler.sh
+#        samples the stacks of a process with gdb "thread apply all bt" and writes
+#        folded stacks for flame graphs (flamegraph.pl, speedscope, ...)
+
+import re
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+import backtrace_parser
+
+_thread_line_regex = re.compile(r'^Thread \d+ \(.*?LWP (?P<lwp>\d+)\)(?: "(?P<name>[^"]*)")?')
+_frame_line_regex = re.compile(r'^#\d+\s+(?:0x[0-9a-fA-F]+ in )?(?P<func>.+?) \((?P<args>.*)\)'
+                               r'(?: at (?P<file>[^:\s]+):(?P<line>\d+)| from (?P<lib>\S+))?\s*$')
+_offset_regex = re.compile(r'\+0x[0-9a-f]+(?= \(|$)')
+
+def _readlines(stream):
+    """iterate the lines of stream as they come, without read-ahead buffering"""
+    while True:
+        line = stream.readline()
+        if not line:
+            break
+        yield line
+
+def iter_stacks(lines, fileLines=False):
+    """parse "thread apply all bt" output as it streams, yield (thread, frames) for
+    every thread, frames go from the outermost to the innermost one"""
+    thread = None
+    frames = []
+    for line in lines:
+        if line.startswith('Thread '):
+            if frames:
+                yield thread, frames[::-1]
+            match = _thread_line_regex.match(line)
+            if match:
+                groups = match.groupdict()
+                thread = '[{} {}]'.format(groups['name'] or 'thread', groups['lwp'])
+            else:
+                thread = '[{}]'.format(line.split(' (', 1)[0].strip().lower())
+            frames = []
+            continue
+        match = _frame_line_regex.match(line)
+        if not match:
+            continue
+        groups = match.groupdict()
+        func = groups['func']
+        if func == '??':
+            # no symbol, name it after its object
+            func = '[{}]'.format(os.path.basename(groups['lib'])) if groups['lib'] else '??'
+        if fileLines and groups['file']:
+            func = '{} ({}:{})'.format(func, groups['file'], groups['line'])
+        frames.append(func)
+    if frames:
+        yield thread, frames[::-1]
+
+class StackTrie(object):
+    """prefix tree of stacks, every node counts the samples ending there"""
+
+    def __init__(self):
+        self.children = {}
+        self.count = 0
+
+    def add(self, frames, count=1):
+        node = self
+        for frame in frames:
+            child = node.children.get(frame)
+            if child is None:
+                child = node.children[frame] = StackTrie()
+            node = child
+        node.count += count
+
+    def _walk(self):
+        """(frames, node) of every node, depth first in frame name order, without
+        recursion since stacks can be deeper than the python recursion limit"""
+        pending = [((), self)]
+        while pending:
+            frames, node = pending.pop()
+            yield frames, node
+            for frame in sorted(node.children, reverse=True):
+                pending.append((frames + (frame,), node.children[frame]))
+
+    def total(self):
+        return sum(node.count for _, node in self._walk())
+
+    def iter_folded(self):
+        """(frames, count) of every stack with samples ending on it"""
+        for frames, node in self._walk():
+            if node.count and frames:
+                yield frames, node.count
+
+    def frames(self):
+        """all the distinct frame names"""
+        names = set()
+        for _, node in self._walk():
+            names.update(node.children)
+        return names
+
+    def relabel(self, names):
+        """new trie with the frames renamed by the names dict, merged when equal"""
+        trie = StackTrie()
+        for frames, count in self.iter_folded():
+            trie.add([names.get(f, f) for f in frames], count)
+        return trie
+
+def clean_symbols(trie):
+    """strip +0x offsets and demangle the names gdb left mangled, with the
+    c++filt co-process of backtrace_parser"""
+    names = {}
+    for frame in trie.frames():
+        name = _offset_regex.sub('', frame)
+        if name != frame or name.startswith('_Z'):
+            names[frame] = name
+    mangled = [n for n in set(names.values()) if n.startswith('_Z')]
+    if mangled:
+        symbolizer = backtrace_parser._Symbolizer(None)
+        try:
+            demangled = dict(zip(mangled, symbolizer.demangle(mangled)))
+        finally:
+            symbolizer.close()
+        for frame, name in names.items():
+            names[frame] = demangled.get(name, name)
+    return trie.relabel(names) if names else trie
+
+def add_stacks(trie, lines, perThread=False, fileLines=False):
+    """add every thread stack of a sample to trie, return the number of threads"""
+    numThreads = 0
+    for thread, frames in iter_stacks(lines, fileLines):
+        trie.add([thread] + frames if perThread else frames)
+        numThreads += 1
+    return numThreads
+
+def sample(pid, trie, perThread=False, fileLines=False):
+    """take one sample with a new gdb session"""
+    gdbProc = subprocess.Popen(
+        ['gdb', '-ex', 'set pagination 0', '-ex', 'set width 0', '-ex', 'thread apply all bt', '-batch', '-p', str(pid)],
+        stdout=subprocess.PIPE,
+        stderr=open(os.devnull, 'w'),
+        universal_newlines=True
+    )
+    try:
+        return add_stacks(trie, _readlines(gdbProc.stdout), perThread, fileLines)
+    finally:
+        gdbProc.stdout.close()
+        gdbProc.wait()
+
+# runs inside gdb attached to the target, samples are asked for over the command pipe
+# and the stacks sent back over the output pipe in "thread apply all bt" format, ended
+# by a "#END <write seconds> <stop seconds>" line, and "#RESUMED <pause seconds>" once
+# the target runs again, paused from the SIGINT on. the target runs in a "continue"
+# between samples, a helper thread stops it with SIGINT (stop, nopass in gdb). a SIGINT
+# is only sent to a target about to run, one left pending at detach would kill it
+_GDB_SAMPLER_SCRIPT = r'''
+import os, time, signal, threading
+import gdb
+
+pid = int(os.environ['PPROFILER_PID'])
+cmdIn = os.fdopen(int(os.environ['PPROFILER_CMD_FD']), 'r')
+out = os.fdopen(int(os.environ['PPROFILER_OUT_FD']), 'w')
+lock = threading.Lock()
+state = {'running': False, 'pending': False, 'quit': False, 'killTime': None}
+
+def read_cmds():
+    while True:
+        cmd = cmdIn.readline().strip()
+        with lock:
+            if cmd != 'sample':
+                state['quit'] = True
+            if state['running']:
+                state['killTime'] = time.time()
+                os.kill(pid, signal.SIGINT)
+            elif cmd == 'sample':
+                state['pending'] = True
+        if cmd != 'sample':
+            break
+
+def frame_line(level, frame):
+    pc = frame.pc()
+    line = '#{}  0x{:x} in {} ()'.format(level, pc, frame.name() or '??')
+    sal = frame.find_sal()
+    if sal.symtab is not None and sal.line:
+        return '{} at {}:{}\n'.format(line, sal.symtab.filename, sal.line)
+    lib = gdb.solib_name(pc)
+    return '{} from {}\n'.format(line, lib) if lib else line + '\n'
+
+def write_stacks():
+    for thread in sorted(gdb.selected_inferior().threads(), key=lambda t: t.num, reverse=True):
+        name = ' "{}"'.format(thread.name) if thread.name else ''
+        out.write('Thread {} (LWP {}){}:\n'.format(thread.num, thread.ptid[1], name))
+        thread.switch()
+        level = 0
+        try:
+            frame = gdb.newest_frame()
+            while frame is not None:
+                out.write(frame_line(level, frame))
+                level += 1
+                frame = frame.older()
+        except gdb.error:
+            pass
+    out.flush()
+
+gdb.execute('set pagination off')
+reader = threading.Thread(target=read_cmds)
+reader.daemon = True
+reader.start()
+out.write('#READY\n')
+out.flush()
+# the target is still stopped by the attach, the first sample may be taken right away
+attached = True
+pausedSince = None
+
+def resumed():
+    global pausedSince
+    if pausedSince is not None:
+        out.write('#RESUMED {:.6f}\n'.format(time.time() - pausedSince))
+        out.flush()
+        pausedSince = None
+
+while True:
+    with lock:
+        if state['quit']:
+            break
+        sampleNow = attached and state['pending']
+        attached = False
+        state['killTime'] = None
+        if not sampleNow:
+            state['running'] = True
+            if state['pending']:
+                # asked for while the last sample was being written, the SIGINT
+                # is delivered once the target resumes
+                state['killTime'] = time.time()
+                os.kill(pid, signal.SIGINT)
+        state['pending'] = False
+    if not sampleNow:
+        resumed()
+        try:
+            gdb.execute('continue', to_string=True)
+        except gdb.error:
+            break
+        with lock:
+            state['running'] = False
+            if state['quit']:
+                break
+            if state['killTime'] is None and gdb.selected_inferior().pid:
+                # stopped by something else than a sample
+                continue
+    if not gdb.selected_inferior().pid:
+        out.write('#EXITED\n')
+        out.flush()
+        break
+    stopped = time.time()
+    stopTime = stopped - state['killTime'] if state['killTime'] else 0
+    write_stacks()
+    out.write('#END {:.6f} {:.6f}\n'.format(time.time() - stopped, stopTime))
+    out.flush()
+    pausedSince = state['killTime'] or stopped
+if gdb.selected_inferior().pid:
+    resumed()
+    gdb.execute('detach', to_string=True)
+'''
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+def sample_continuous(pid, trie, samples, frequency, perThread=False, fileLines=False):
+    """attach gdb once and take samples at frequency Hz in the same session, return
+    [pause, stop, write] seconds of every sample, None if gdb failed. pause is the whole
+    time the target was stopped, of which stop went to stopping it and write to the stacks"""
+    cmdRead, cmdWrite = os.pipe()
+    outRead, outWrite = os.pipe()
+    scriptFd, scriptPath = tempfile.mkstemp(prefix='pprofiler-', suffix='.py')
+    with os.fdopen(scriptFd, 'w') as f:
+        f.write(_GDB_SAMPLER_SCRIPT)
+    env = dict(os.environ, PPROFILER_PID=str(pid), PPROFILER_CMD_FD=str(cmdRead), PPROFILER_OUT_FD=str(outWrite))
+    # the pipes are inherited by gdb, and gdb gets its own session so that ctrl-c
+    # reaches the profiler only, which then detaches cleanly
+    fdArgs = {'pass_fds': (cmdRead, outWrite)} if sys.version_info[0] >= 3 else {'close_fds': False}
+    gdbProc = subprocess.Popen(
+        ['gdb', '-q', '-nx', '-batch', '-p', str(pid), '-x', scriptPath],
+        stdin=open(os.devnull),
+        stdout=open(os.devnull, 'w'),
+        stderr=open(os.devnull, 'w'),
+        env=env,
+        preexec_fn=os.setsid,
+        **fdArgs
+    )
+    os.close(cmdRead)
+    os.close(outWrite)
+    cmds = os.fdopen(cmdWrite, 'w')
+    results = os.fdopen(outRead, 'r')
+    pauses = []
+    try:
+        if results.readline() != '#READY\n':
+            return None
+        startTime = time.time()
+        for x in range(samples):
+            delay = startTime + float(x) / frequency - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            cmds.write('sample\n')
+            cmds.flush()
+            lines = []
+            for line in _readlines(results):
+                if line.startswith('#RESUMED '):
+                    # of the previous sample
+                    pauses[-1][0] = float(line.split()[1])
+                    continue
+                if line.startswith('#END '):
+                    write, stop = [float(v) for v in line.split()[1:3]]
+                    # until the resume tells the whole pause
+                    pauses.append([stop + write, stop, write])
+                    break
+                lines.append(line)
+            else:
+                # the target exited, or gdb did
+                break
+            add_stacks(trie, lines, perThread, fileLines)
+    except KeyboardInterrupt:
+        # stop sampling, keep what was sampled
+        pass
+    finally:
+        try:
+            cmds.write('quit\n')
+            cmds.close()
+        except (IOError, OSError):
+            pass
+        # the stacks gdb may still write, and the pause of the last sample
+        for line in results.read().splitlines():
+            if line.startswith('#RESUMED ') and pauses:
+                pauses[-1][0] = float(line.split()[1])
+        results.close()
+        gdbProc.wait()
+        os.remove(scriptPath)
+    return pauses
+
+def report_pauses(pauses, elapsed, out):
+    pauseMs, stopMs, writeMs = [[p[i] * 1000 for p in pauses] for i in range(3)]
+    out.write('{} samples in {:.2f}s, {:.1f} samples/s\n'.format(len(pauses), elapsed, len(pauses) / elapsed))
+    out.write('target paused per sample: avg {:.2f}ms p50 {:.2f}ms p99 {:.2f}ms max {:.2f}ms, '
+              'of which stopping took avg {:.2f}ms and writing the stacks avg {:.2f}ms\n'.format(
+        sum(pauseMs) / len(pauseMs), _percentile(pauseMs, 50), _percentile(pauseMs, 99), max(pauseMs),
+        sum(stopMs) / len(stopMs), sum(writeMs) / len(writeMs)))
+    out.write('target paused {:.2f}% of the time\n'.format(sum(pauseMs) / 10.0 / elapsed))
+
+def write_folded(trie, out):
+    for frames, count in trie.iter_folded():
+        out.write('{} {}\n'.format(';'.join(f.replace(';', ':') for f in frames), count))
+
+def main(args):
+    trie = StackTrie()
+    if args.input:
+        with (sys.stdin if args.input == '-' else open(args.input)) as f:
+            add_stacks(trie, _readlines(f), args.per_thread, args.lines)
+    elif args.frequency:
+        startTime = time.time()
+        pauses = sample_continuous(args.pid, trie, args.samples, args.frequency, args.per_thread, args.lines)
+        if pauses is None or not trie.total():
+            sys.stderr.write('no stack sampled from {}, is it running and is gdb allowed to attach?\n'.format(args.pid))
+            return 1
+        if pauses:
+            report_pauses(pauses, time.time() - startTime, sys.stderr)
+        if args.pause_log:
+            with open(args.pause_log, 'w') as f:
+                for pause, stop, write in pauses:
+                    f.write('{:.3f} {:.3f} {:.3f}\n'.format(pause * 1000, stop * 1000, write * 1000))
+    else:
+        for x in range(args.samples):
+            if x and args.interval:
+                time.sleep(args.interval)
+            if not sample(args.pid, trie, args.per_thread, args.lines):
+                sys.stderr.write('no stack sampled from {}, is it running and is gdb allowed to attach?\n'.format(args.pid))
+                if not trie.total():
+                    return 1
+    if args.clean:
+        trie = clean_symbols(trie)
+    if args.output:
+        with open(args.output, 'w') as out:
+            write_folded(trie, out)
+    else:
+        write_folded(trie, sys.stdout)
+    sys.stderr.write('{} stacks sampled\n'.format(trie.total()))
+    return 0
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description="poor man's profiler, writes folded stacks for flame graphs")
+    argParser.add_argument('pid', nargs='?', type=int, help='pid of the process to profile')
+    argParser.add_argument('-n', '--samples', type=int, default=1, help='number of samples, default %(default)s')
+    argParser.add_argument('-i', '--interval', type=float, default=0, help='seconds to sleep between samples, default %(default)s')
+    argParser.add_argument('-f', '--frequency', type=float,
+        help='attach once and take the samples at this rate (Hz) in the same gdb session, reports how long the target was paused')
+    argParser.add_argument('--pause-log', help='with -f, write the pause, stop and stack writing time (ms) of every sample to this file')
+    argParser.add_argument('-t', '--per-thread', action='store_true', default=False,
+        help='keep the stacks of every thread apart, under a [name lwp] root frame')
+    argParser.add_argument('-l', '--lines', action='store_true', default=False, help='add file:line to the frames')
+    argParser.add_argument('--raw', dest='clean', action='store_false', default=True,
+        help='keep the symbols as gdb printed them, no offset stripping or demangling')
+    argParser.add_argument('-o', '--output', help='folded stacks output file, default stdout')
+    argParser.add_argument('--input', help='parse saved "thread apply all bt" output instead of attaching, - for stdin')
+    args = argParser.parse_args()
+    if args.pid is None and not args.input:
+        argParser.error('a pid or --input is required')
+    if args.samples < 1 or args.interval < 0 or (args.frequency is not None and args.frequency <= 0):
+        argParser.error('invalid number of samples, interval or frequency')
+    sys.exit(main(args))
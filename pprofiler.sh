@@ -23,7 +23,7 @@ fi
 
 sleeptime=0
 if [[ $# > 2 ]]; then
-    sleeptime=$2
+    sleeptime=$3
 fi
 
 for x in $(seq 1 $nsamples)
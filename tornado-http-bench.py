@@ -2,56 +2,381 @@
 # -*- coding: utf-8 -*-
 
 import tornado
+import tornado.gen
 import tornado.iostream
+import tornado.httputil
+import tornado.tcpclient
+import tornado.tcpserver
 import tornado.httpclient
+import tornado.http1connection
+import tornado.process
 import signal
 import multiprocessing
 import os
 import sys
 import struct
 import functools
+import itertools
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
+try:
+    import urlparse
+except ImportError:
+    import urllib.parse as urlparse
+import collections
+import csv
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import bisect
+import random
+import json
+import re
+import copy
+import ctypes
+import hashlib
+import zlib
+from io import BytesIO
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+import ssl
+import socket
+import subprocess
+import resource
+import tempfile
 import time
 import argparse
-
-now_exit = False
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
 
 def stdout_erase_lines(num=1):
     # cursor up + line erase + column 0
     sys.stdout.write('\x1b[1A\x1b[2K' * num + '\r')
     sys.stdout.flush()
 
+def readable_size(num_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if num_bytes < 1024:
+            break
+        num_bytes /= 1024.0
+    return '{:.2f}{}'.format(num_bytes, unit)
+
+def available_cpus():
+    """CPUs this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+def parse_cpu_list(text):
+    """'0-3,6' style cpu list, 'all' for every available cpu."""
+    if text == 'all':
+        return available_cpus()
+    cpus = []
+    for item in text.split(','):
+        first, sep, last = item.partition('-')
+        cpus.extend(range(int(first), int(last) + 1) if sep else [int(first)])
+    return cpus
+
+def set_cpu_affinity(cpu):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [cpu])
+        return
+    # python2, call sched_setaffinity(2) directly with a cpu_set_t
+    mask_bits = ctypes.sizeof(ctypes.c_ulong) * 8
+    mask = (ctypes.c_ulong * (1024 // mask_bits))()
+    mask[cpu // mask_bits] = 1 << (cpu % mask_bits)
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        raise OSError(ctypes.get_errno(), 'sched_setaffinity failed')
+
 class SubCmd(object):
+    """Message between the processes of this tool. Pickled between a parent
+    and its workers, json between a coordinator and its agents, a remote
+    peer must not be able to run code here."""
     CmdResult = 0
     CmdExit = 1
+    # coordinator <=> agent only, the payload of CmdConfig is the run args
+    CmdConfig = 2
+    CmdReady = 3
+    CmdStart = 4
+    # new load of a running worker or agent, see RampController
+    CmdLoad = 5
+    # a remote message is a run config or a cumulative result, far below this
+    MAX_REMOTE_LEN = 64 << 20
+    # the run args read by an agent and its workers and their json types, None
+    # is allowed where the option may be left out
+    _TEXT = (type(u''), str)
+    _NUMBER = (int, float)
+    CONFIG_FIELDS = {
+        'url': (_TEXT, False), 'procs': (int, False), 'coroutines': (int, False),
+        'cpu_affinity': (_TEXT, True), 'keepalive': (bool, False), 'engine': (_TEXT, False),
+        'pipeline': (int, False), 'rate': (_NUMBER, False), 'scenario': (_TEXT, True),
+        'scenario_mode': (_TEXT, False), 'stream': (bool, False), 'expect_size': (int, True),
+        'expect_hash': (_TEXT, True), 'expect_substring': (_TEXT, True), 'duration': (_NUMBER, False),
+        'requests': (int, True), 'warmup': (_NUMBER, False), 'transport': (_TEXT, False),
+    }
 
     def __init__(self, cmd, result=None):
         self.cmd = cmd
         self.result = result
 
-    def msg(self):
-        objstr = pickle.dumps(self, 2)
+    def msg(self, remote=False):
+        if remote:
+            result = self.result
+            if self.cmd == self.CmdConfig:
+                result = vars(result)
+            elif self.cmd == self.CmdResult:
+                result = result.to_json()
+            objstr = json.dumps({'cmd': self.cmd, 'result': result}).encode('utf-8')
+        else:
+            objstr = pickle.dumps(self, 2)
         strlen = len(objstr)
         return struct.pack('<I%ds' % (strlen), strlen, objstr)
 
     @classmethod
-    def load(cls, msg):
-        return pickle.loads(msg)
+    def load(cls, msg, remote=False):
+        if not remote:
+            return pickle.loads(msg)
+        data = json.loads(msg.decode('utf-8'))
+        cmd, result = data['cmd'], data['result']
+        if cmd == cls.CmdConfig:
+            cls.check_config(result)
+            result = argparse.Namespace(**result)
+        elif cmd == cls.CmdResult:
+            result = LoadResult.from_json(result)
+        return cls(cmd, result)
+
+    @classmethod
+    def check_config(cls, config):
+        """Raises ValueError unless config has every field of CONFIG_FIELDS
+        with the right type, a bad one would only fail in the workers."""
+        if not isinstance(config, dict):
+            raise ValueError('config is not an object')
+        for name, (types, optional) in sorted(cls.CONFIG_FIELDS.items()):
+            if name not in config:
+                raise ValueError('config field {} is missing'.format(name))
+            value = config[name]
+            if value is None and optional:
+                continue
+            if not isinstance(value, types) or (isinstance(value, bool) and types is not bool):
+                raise ValueError('config field {} is {!r}'.format(name, value))
+
+    @classmethod
+    @tornado.gen.coroutine
+    def read(cls, stream, remote=False):
+        """Raises ValueError on a remote message which is not a valid one."""
+        data = yield stream.read_bytes(4)
+        strlen = struct.unpack('<I', data)[0]
+        if remote and strlen > cls.MAX_REMOTE_LEN:
+            raise ValueError('message of {} bytes'.format(strlen))
+        data = yield stream.read_bytes(strlen)
+        try:
+            raise tornado.gen.Return(cls.load(data, remote))
+        except (KeyError, TypeError, IndexError, AttributeError) as e:
+            raise ValueError('bad message: {!r}'.format(e))
+
+class Histogram(object):
+    """Log-linear latency histogram (HDR style), values are in microseconds.
+
+    Values below 2**SUB_BITS get an exact bucket, above that every power of
+    two is split into 2**(SUB_BITS-1) linear sub buckets, which bounds the
+    relative error to ~1.6% while the bucket count stays fixed.
+    """
+    SUB_BITS = 7
+    HALF_SUB_COUNT = 1 << (SUB_BITS - 1)
+    MAX_VALUE = 3600 * 1000 * 1000
+    NUM_BUCKETS = HALF_SUB_COUNT * (MAX_VALUE.bit_length() - SUB_BITS) + (1 << SUB_BITS)
+
+    def __init__(self):
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min_value = self.MAX_VALUE
+        self.max_value = 0
+
+    @classmethod
+    def bucket_index(cls, value):
+        exp = max(0, value.bit_length() - cls.SUB_BITS)
+        return cls.HALF_SUB_COUNT * exp + (value >> exp)
+
+    @classmethod
+    def bucket_low(cls, index):
+        exp = max(0, index // cls.HALF_SUB_COUNT - 1)
+        return (index - cls.HALF_SUB_COUNT * exp) << exp
+
+    @classmethod
+    def bucket_high(cls, index):
+        exp = max(0, index // cls.HALF_SUB_COUNT - 1)
+        sub = index - cls.HALF_SUB_COUNT * exp
+        return ((sub + 1) << exp) - 1
+
+    def record(self, value):
+        value = min(max(int(value), 0), self.MAX_VALUE)
+        self.buckets[self.bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min_value:
+            self.min_value = value
+        if value > self.max_value:
+            self.max_value = value
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        buckets = self.buckets
+        for i, v in enumerate(other.buckets):
+            if v:
+                buckets[i] += v
+        self.count += other.count
+        self.total += other.total
+        self.min_value = min(self.min_value, other.min_value)
+        self.max_value = max(self.max_value, other.max_value)
+
+    def percentile(self, pct):
+        if self.count == 0:
+            return 0
+        rank = max(1, int(self.count * pct / 100.0 + 0.5))
+        seen = 0
+        for i, v in enumerate(self.buckets):
+            seen += v
+            if seen >= rank:
+                return min(self.bucket_high(i), self.max_value)
+        return self.max_value
+
+    def mean(self):
+        return self.total / float(self.count) if self.count else 0.0
+
+    def diff(self, older):
+        """Histogram of the values recorded since older was copied from this
+        one, min and max are only known up to their bucket."""
+        hist = Histogram()
+        hist.buckets = [a - b for a, b in zip(self.buckets, older.buckets)]
+        hist.count = self.count - older.count
+        hist.total = self.total - older.total
+        used = [i for i, v in enumerate(hist.buckets) if v]
+        if used:
+            hist.min_value = max(self.min_value, self.bucket_low(used[0]))
+            hist.max_value = min(self.max_value, self.bucket_high(used[-1]))
+        return hist
+
+    def to_dict(self, percentiles):
+        """Summary in milliseconds."""
+        summary = {
+            'count': self.count,
+            'min': (self.min_value if self.count else 0) / 1000.0,
+            'max': self.max_value / 1000.0,
+            'avg': self.mean() / 1000.0,
+        }
+        for p in percentiles:
+            summary['p{:g}'.format(p)] = self.percentile(p) / 1000.0
+        return summary
+
+    def __getstate__(self):
+        # only ship non-empty buckets, most of them are zero
+        used = [(i, v) for i, v in enumerate(self.buckets) if v]
+        return (self.count, self.total, self.min_value, self.max_value, used)
+
+    def __setstate__(self, state):
+        self.count, self.total, self.min_value, self.max_value, used = state
+        self.buckets = [0] * self.NUM_BUCKETS
+        for i, v in used:
+            self.buckets[i] = v
+
+class GroupResult(object):
+    """Stats of the requests of one scenario group (URL path by default)."""
+    def __init__(self):
+        self.num_requests = 0
+        self.num_errors = 0
+        self.resp_hist = Histogram()
+
+    def update(self, other):
+        self.num_requests += other.num_requests
+        self.num_errors += other.num_errors
+        self.resp_hist.merge(other.resp_hist)
+
+    def diff(self, older):
+        group = GroupResult()
+        group.num_requests = self.num_requests - older.num_requests
+        group.num_errors = self.num_errors - older.num_errors
+        group.resp_hist = self.resp_hist.diff(older.resp_hist)
+        return group
+
+class WorkerLoad(object):
+    """Latest event loop lag and CPU usage of a worker process, plus their
+    peaks and how many of the samples were saturated over the run (warm-up
+    excluded)."""
+    # a worker above either limit cannot keep up, the results then measure
+    # the load generator rather than the server
+    SATURATED_CPU = 90
+    SATURATED_LOOP_LAG = 20
+
+    def __init__(self, loop_lag, cpu):
+        # lag in ms, cpu in percent of one core
+        self.loop_lag = loop_lag
+        self.cpu = cpu
+        self.peak_loop_lag = 0.0
+        self.peak_cpu = 0.0
+        self.num_samples = 0
+        self.num_saturated = 0
+        # CPU seconds used so far
+        self.cpu_time = 0.0
+
+    def saturated(self):
+        return self.cpu >= self.SATURATED_CPU or self.loop_lag >= self.SATURATED_LOOP_LAG
+
+    def mostly_saturated(self):
+        return self.num_saturated * 2 > self.num_samples
 
 class LoadResult(object):
+    PERCENTILES = (50, 90, 99, 99.9)
+    # groups beyond the limit are accounted as OTHER_GROUP
+    MAX_GROUPS = 64
+    OTHER_GROUP = '(other)'
+    SHOW_GROUPS = 5
+    # plain counters and histograms, summed up by update()
+    # num_invalid counts responses failing the body checks, they are
+    # counted in num_errors as well. num_dropped counts open-loop requests
+    # still queued at the stop, due but never sent
+    COUNTERS = ('num_requests', 'num_errors', 'num_new_conns', 'num_reused_conns', 'num_bytes', 'num_invalid',
+                'num_dropped')
+    # phases of a request: connect (including DNS, new connections only),
+    # time to first byte of the response and body transfer
+    PHASES = ('connect', 'ttfb', 'transfer')
+    PHASE_HISTOGRAMS = tuple(name + '_hist' for name in PHASES)
+    HISTOGRAMS = ('resp_hist', 'sched_lag_hist') + PHASE_HISTOGRAMS
+
     def __init__(self):
         self._prev_show_lines = 0
         self.begin_time = time.time()
-        self.num_requests = 0
-        self.num_errors = 0
+        # set once the run is over
+        self.end_time = None
+        self.clear()
+
+    def clear(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
         self.status_map = {}
-        self.total_resp_time = 0
-        self.avg_resp_time = 0
-        self.max_resp_time = 0
-        self.min_resp_time = 999999
+        for name in self.HISTOGRAMS:
+            setattr(self, name, Histogram())
+        self.groups = {}
+        # worker name => WorkerLoad, not summed up, newer values replace older
+        self.worker_loads = {}
+
+    def group(self, name):
+        if name not in self.groups:
+            if len(self.groups) >= self.MAX_GROUPS:
+                name = self.OTHER_GROUP
+            if name not in self.groups:
+                self.groups[name] = GroupResult()
+        return self.groups[name]
 
     def new_status(self, code):
         if code in self.status_map:
@@ -62,20 +387,134 @@ class LoadResult(object):
     def update(self, other):
         if other is None:
             return
-        self.num_requests += other.num_requests
-        self.num_errors += other.num_errors
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
         for k, v in other.status_map.items():
             if k not in self.status_map:
                 self.status_map[k] = v
             else:
                 self.status_map[k] += v
-        self.total_resp_time += other.total_resp_time
-        self.avg_resp_time = self.total_resp_time / self.num_requests
-        self.max_resp_time = max(self.max_resp_time, other.max_resp_time)
-        self.min_resp_time = min(self.min_resp_time, other.min_resp_time)
+        for name in self.HISTOGRAMS:
+            getattr(self, name).merge(getattr(other, name))
+        for k, v in other.groups.items():
+            self.group(k).update(v)
+        self.worker_loads.update(other.worker_loads)
+
+    def to_json(self):
+        """The stats as plain data, see SubCmd. Histograms use their pickle
+        state, status codes stay pairs since json keys are strings."""
+        data = dict((name, getattr(self, name)) for name in self.COUNTERS)
+        for name in self.HISTOGRAMS:
+            data[name] = getattr(self, name).__getstate__()
+        data['status_map'] = list(self.status_map.items())
+        data['groups'] = dict((k, (g.num_requests, g.num_errors, g.resp_hist.__getstate__()))
+                              for k, g in self.groups.items())
+        data['worker_loads'] = dict((k, vars(v)) for k, v in self.worker_loads.items())
+        return data
+
+    @classmethod
+    def from_json(cls, data):
+        result = cls()
+        for name in cls.COUNTERS:
+            setattr(result, name, int(data[name]))
+        for name in cls.HISTOGRAMS:
+            getattr(result, name).__setstate__(data[name])
+        result.status_map = dict((code, int(v)) for code, v in data['status_map'])
+        for k, (num_requests, num_errors, hist) in data['groups'].items():
+            group = result.group(k)
+            group.num_requests, group.num_errors = int(num_requests), int(num_errors)
+            group.resp_hist.__setstate__(hist)
+        for k, v in data['worker_loads'].items():
+            load = WorkerLoad(0.0, 0.0)
+            for attr in vars(load):
+                setattr(load, attr, v[attr])
+            result.worker_loads[k] = load
+        return result
+
+    def _sorted_groups(self):
+        return sorted(self.groups.items(), key=lambda item: -item[1].num_requests)
+
+    def diff(self, older):
+        """Stats of what happened since older was copied from this result."""
+        result = LoadResult()
+        result.begin_time = older.begin_time
+        for name in self.COUNTERS:
+            setattr(result, name, getattr(self, name) - getattr(older, name))
+        for k, v in self.status_map.items():
+            v -= older.status_map.get(k, 0)
+            if v:
+                result.status_map[k] = v
+        for name in self.HISTOGRAMS:
+            setattr(result, name, getattr(self, name).diff(getattr(older, name)))
+        for k, v in self.groups.items():
+            result.groups[k] = v.diff(older.groups[k]) if k in older.groups else v
+        result.worker_loads = dict(self.worker_loads)
+        return result
+
+    def saturated_workers(self):
+        return [load for load in self.worker_loads.values() if load.saturated()]
+
+    def to_dict(self, elapsed):
+        summary = {
+            'elapsed': elapsed,
+            'requests': self.num_requests,
+            'errors': self.num_errors,
+            'rate': self.num_requests / elapsed if elapsed > 0 else 0.0,
+            'status': dict((str(k), v) for k, v in self.status_map.items()),
+            'new_conns': self.num_new_conns,
+            'reused_conns': self.num_reused_conns,
+            'bytes': self.num_bytes,
+            'invalid': self.num_invalid,
+            'dropped': self.num_dropped,
+            'resp_time_ms': self.resp_hist.to_dict(self.PERCENTILES),
+        }
+        if self.sched_lag_hist.count:
+            summary['sched_lag_ms'] = self.sched_lag_hist.to_dict(self.PERCENTILES)
+        phases = dict((name, getattr(self, hist_name).to_dict(self.PERCENTILES))
+                      for name, hist_name in zip(self.PHASES, self.PHASE_HISTOGRAMS)
+                      if getattr(self, hist_name).count)
+        if phases:
+            summary['phases_ms'] = phases
+        if self.groups:
+            summary['groups'] = dict(
+                (name, {'requests': g.num_requests, 'errors': g.num_errors,
+                        'resp_time_ms': g.resp_hist.to_dict(self.PERCENTILES)})
+                for name, g in self.groups.items())
+        if self.worker_loads:
+            loads = self.worker_loads.values()
+            summary['generator'] = {
+                'workers': len(self.worker_loads),
+                'cpu_max': max(load.cpu for load in loads),
+                'loop_lag_max_ms': max(load.loop_lag for load in loads),
+                'peak_cpu_max': max(load.peak_cpu for load in loads),
+                'peak_loop_lag_max_ms': max(load.peak_loop_lag for load in loads),
+                'saturated_workers': len(self.saturated_workers()),
+                'mostly_saturated_workers': sum(1 for load in loads if load.mostly_saturated()),
+                'cpu_seconds': sum(load.cpu_time for load in loads),
+            }
+        return summary
+
+    def _hist_line(self, hist):
+        items = ['min {:.2f}'.format((hist.min_value if hist.count else 0) / 1000.0)]
+        for p in self.PERCENTILES:
+            items.append('p{:g} {:.2f}'.format(p, hist.percentile(p) / 1000.0))
+        items.append('max {:.2f}'.format(hist.max_value / 1000.0))
+        items.append('avg {:.2f}'.format(hist.mean() / 1000.0))
+        return ' | '.join(items)
+
+    def _print_hist(self, title, hist):
+        print(title)
+        print('    {:<21}{:.2f}'.format('min', (hist.min_value if hist.count else 0) / 1000.0))
+        for p in self.PERCENTILES:
+            print('    {:<21}{:.2f}'.format('p{:g}'.format(p), hist.percentile(p) / 1000.0))
+        print('    {:<21}{:.2f}'.format('max', hist.max_value / 1000.0))
+        print('    {:<21}{:.2f}'.format('avg', hist.mean() / 1000.0))
+
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.begin_time
 
     def _readable_elaps_time(self):
-        elaps_time = time.time() - self.begin_time
+        elaps_time = self.elapsed()
         if elaps_time > 24 * 3600:
             return '{:.2f}d'.format(elaps_time / 24 * 3600)
         elif elaps_time > 3600:
@@ -88,7 +527,7 @@ class LoadResult(object):
     def show(self):
         if self._prev_show_lines > 0:
             stdout_erase_lines(self._prev_show_lines)
-        req_rate = self.num_requests / (time.time() - self.begin_time)
+        req_rate = self.num_requests / self.elapsed()
         status_line = ''
         for k, v in self.status_map.items():
             status_line += ('{} ({}) | '.format(k, v))
@@ -98,147 +537,2232 @@ class LoadResult(object):
             req_rate,
             self.num_errors))
         print('{:<25}{}'.format('response status:', status_line[:-3]))
-        print('{:<25}min {:4.2f} | max {:4.2f} | avg {:4.2f}'.format(
-            'response time(ms):',
-            self.min_resp_time,
-            self.max_resp_time,
-            self.avg_resp_time))
-        self._prev_show_lines = 3
+        print('{:<25}new {} | reused {}'.format(
+            'connections:', self.num_new_conns, self.num_reused_conns))
+        print('{:<25}{} | {}/s | invalid: {}'.format(
+            'body received:', readable_size(self.num_bytes),
+            readable_size(self.num_bytes / self.elapsed()), self.num_invalid))
+        print('{:<25}{}'.format('response time(ms):', self._hist_line(self.resp_hist)))
+        self._prev_show_lines = 5
+        if self.sched_lag_hist.count:
+            print('{:<25}{}'.format('schedule lag(ms):', self._hist_line(self.sched_lag_hist)))
+            self._prev_show_lines += 1
+        phases = ['{} {:.2f}/{:.2f}'.format(name, getattr(self, hist_name).percentile(50) / 1000.0,
+                                            getattr(self, hist_name).percentile(99) / 1000.0)
+                  for name, hist_name in zip(self.PHASES, self.PHASE_HISTOGRAMS)
+                  if getattr(self, hist_name).count]
+        if phases:
+            print('{:<25}{}'.format('phases(ms, p50/p99):', ' | '.join(phases)))
+            self._prev_show_lines += 1
+        for name, group in self._sorted_groups()[:self.SHOW_GROUPS]:
+            print('  {:<23}total {} | errors {} | p50 {:.2f} | p99 {:.2f}'.format(
+                name[:23], group.num_requests, group.num_errors,
+                group.resp_hist.percentile(50) / 1000.0,
+                group.resp_hist.percentile(99) / 1000.0))
+            self._prev_show_lines += 1
+        if self.worker_loads:
+            loads = self.worker_loads.values()
+            print('{:<25}cpu max {:.0f}% | loop lag max {:.2f}ms | workers {}'.format(
+                'generator:', max(load.cpu for load in loads),
+                max(load.loop_lag for load in loads), len(self.worker_loads)))
+            self._prev_show_lines += 1
+            saturated = len(self.saturated_workers())
+            if saturated:
+                print('WARNING: {} of {} workers saturated, the load generator is the bottleneck '
+                      '(add processes with -f or more agents)'.format(saturated, len(self.worker_loads)))
+                self._prev_show_lines += 1
 
-class Request(object):
-    def __init__(self, url, output):
-        self.url = url
+    def report(self):
+        elaps_time = self.elapsed()
+        print('\n{:<25}{}'.format('elapsed:', self._readable_elaps_time()))
+        print('{:<25}{}'.format('requests:', self.num_requests))
+        print('{:<25}{}'.format('errors:', self.num_errors))
+        print('{:<25}{:.2f} #/s'.format('rate:', self.num_requests / elaps_time))
+        print('{:<25}{}'.format('response status:', ' | '.join(
+            '{} ({})'.format(k, v) for k, v in sorted(self.status_map.items()))))
+        print('{:<25}new {} | reused {}'.format(
+            'connections:', self.num_new_conns, self.num_reused_conns))
+        print('{:<25}{} | {}/s'.format(
+            'body received:', readable_size(self.num_bytes), readable_size(self.num_bytes / elaps_time)))
+        if self.num_invalid:
+            print('{:<25}{}'.format('invalid body:', self.num_invalid))
+        if self.num_dropped:
+            print('{:<25}{}'.format('dropped (never sent):', self.num_dropped))
+        self._print_hist('response time(ms):', self.resp_hist)
+        if self.sched_lag_hist.count:
+            # how long requests waited past their scheduled send time
+            self._print_hist('schedule lag(ms):', self.sched_lag_hist)
+        for name, hist_name in zip(self.PHASES, self.PHASE_HISTOGRAMS):
+            hist = getattr(self, hist_name)
+            if hist.count:
+                self._print_hist('{} time(ms):'.format(name), hist)
+        if self.groups:
+            print('groups, response time(ms):')
+            print('    {:<40}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+                'group', 'total', 'errors', 'p50', 'p99', 'max'))
+            for name, group in self._sorted_groups():
+                print('    {:<40}{:>10}{:>10}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+                    name[:40], group.num_requests, group.num_errors,
+                    group.resp_hist.percentile(50) / 1000.0,
+                    group.resp_hist.percentile(99) / 1000.0,
+                    group.resp_hist.max_value / 1000.0))
+        if self.worker_loads:
+            loads = self.worker_loads.values()
+            print('{:<25}peak cpu {:.0f}% | peak loop lag {:.2f}ms | workers {}'.format(
+                'generator:', max(load.peak_cpu for load in loads),
+                max(load.peak_loop_lag for load in loads), len(self.worker_loads)))
+            saturated = sum(1 for load in loads if load.mostly_saturated())
+            if saturated:
+                print('WARNING: {} of {} workers were saturated most of the run, the results are '
+                      'limited by the load generator rather than by the server'.format(
+                          saturated, len(self.worker_loads)))
+
+class SharedResultSlots(object):
+    """Fixed-layout LoadResult counters in shared memory, one slot per worker.
+
+    A worker owns its slot and periodically overwrites it with its
+    cumulative result, the parent sums all the slots on a timer. Every slot
+    starts with a sequence number which is odd while the slot is being
+    written, so the reader can retry instead of seeing a torn slot. A worker
+    killed in the middle of a write leaves its slot odd for good, after
+    READ_TIMEOUT seconds the last consistent copy of the slot is used.
+
+    Slot layout: seq, LoadResult.COUNTERS, status code counters, then for
+    every one of LoadResult.HISTOGRAMS count, total, min, max and buckets.
+    """
+    NUM_STATUS_CODES = 600
+    SEQ = 0
+    STATUS_OFFSET = 1 + len(LoadResult.COUNTERS)
+    HIST_OFFSET = STATUS_OFFSET + NUM_STATUS_CODES
+    HIST_SIZE = 4 + Histogram.NUM_BUCKETS
+    SLOT_SIZE = HIST_OFFSET + HIST_SIZE * len(LoadResult.HISTOGRAMS)
+    # a write takes well below a millisecond
+    READ_TIMEOUT = 0.1
+
+    def __init__(self, num_slots):
+        self.num_slots = num_slots
+        self.array = multiprocessing.RawArray(ctypes.c_longlong, num_slots * self.SLOT_SIZE)
+        # last consistent values of every slot, kept by the reader
+        self.last_values = [None] * num_slots
+
+    def write(self, slot, result):
+        base = slot * self.SLOT_SIZE
+        values = [getattr(result, name) for name in LoadResult.COUNTERS]
+        status_codes = [0] * self.NUM_STATUS_CODES
+        for k, v in result.status_map.items():
+            # codes out of range are accounted as 0
+            status_codes[k if 0 <= k < self.NUM_STATUS_CODES else 0] += v
+        values.extend(status_codes)
+        for name in LoadResult.HISTOGRAMS:
+            hist = getattr(result, name)
+            values.extend((hist.count, hist.total, hist.min_value, hist.max_value))
+            values.extend(hist.buckets)
+        self.array[base + self.SEQ] += 1
+        self.array[base + 1:base + self.SLOT_SIZE] = values
+        self.array[base + self.SEQ] += 1
+
+    def _read_slot(self, slot):
+        """Values of slot, None if it was never read consistently."""
+        base = slot * self.SLOT_SIZE
+        deadline = time.time() + self.READ_TIMEOUT
+        while time.time() < deadline:
+            seq = self.array[base + self.SEQ]
+            if seq % 2 == 0:
+                values = self.array[base:base + self.SLOT_SIZE]
+                if self.array[base + self.SEQ] == seq:
+                    self.last_values[slot] = values
+                    return values
+            time.sleep(0)
+        return self.last_values[slot]
+
+    def read_into(self, result):
+        """Replace the stats of result with the sum of all slots."""
+        # groups and worker loads have no fixed layout, they are sent over
+        # the result pipe
+        groups, worker_loads = result.groups, result.worker_loads
+        result.clear()
+        result.groups, result.worker_loads = groups, worker_loads
+        for slot in range(self.num_slots):
+            values = self._read_slot(slot)
+            if values is None:
+                continue
+            other = LoadResult()
+            for i, name in enumerate(LoadResult.COUNTERS):
+                setattr(other, name, values[1 + i])
+            if not any(values[1:self.STATUS_OFFSET]):
+                continue
+            for code in range(self.NUM_STATUS_CODES):
+                if values[self.STATUS_OFFSET + code]:
+                    other.status_map[code] = values[self.STATUS_OFFSET + code]
+            offset = self.HIST_OFFSET
+            for name in LoadResult.HISTOGRAMS:
+                hist = getattr(other, name)
+                hist.count, hist.total, hist.min_value, hist.max_value = values[offset:offset + 4]
+                hist.buckets = values[offset + 4:offset + self.HIST_SIZE]
+                offset += self.HIST_SIZE
+            result.update(other)
+
+class PipeReporter(object):
+    """Ships the worker result to the parent over a pipe every 10 responses,
+    but at most once per FLUSH_INTERVAL ms. Pickling the histograms is not
+    free, at high rates flushing more often would saturate the parent. A
+    timer sends what is left over."""
+    FLUSH_INTERVAL = 50
+
+    def __init__(self, output):
         self.output = output
-        self.client = None
         self.result = LoadResult()
+        self.last_flush = time.time()
+        self.timer = tornado.ioloop.PeriodicCallback(self.flush, self.FLUSH_INTERVAL)
+        self.timer.start()
+
+    def on_response(self):
+        if (self.result.num_requests % 10 == 0 and
+                time.time() - self.last_flush >= self.FLUSH_INTERVAL / 1000.0):
+            self.flush()
+
+    def flush(self):
+        if self.result.num_requests == 0 and not self.result.worker_loads:
+            return
+        self.output.write(SubCmd(SubCmd.CmdResult, self.result).msg())
+        self.result = LoadResult()
+        self.last_flush = time.time()
+
+    def close(self, callback):
+        """Flush the final result and tell the parent this worker is done,
+        callback runs once it is written."""
+        self.timer.stop()
+        self.flush()
+        future = self.output.write(SubCmd(SubCmd.CmdExit).msg())
+        tornado.ioloop.IOLoop.current().add_future(future, lambda f: callback())
+
+class ShmReporter(object):
+    """Copies the cumulative worker result into its shared memory slot.
+
+    Group stats and worker loads have no fixed layout, they go over the
+    result pipe once a second instead.
+    """
+    FLUSH_INTERVAL = 100
+    GROUPS_INTERVAL = 1000
+
+    def __init__(self, slots, slot, output):
+        self.slots = slots
+        self.slot = slot
+        self.output = output
+        self.result = LoadResult()
+        self.timers = [tornado.ioloop.PeriodicCallback(self.flush, self.FLUSH_INTERVAL),
+                       tornado.ioloop.PeriodicCallback(self.flush_groups, self.GROUPS_INTERVAL)]
+        for timer in self.timers:
+            timer.start()
+
+    def on_response(self):
+        pass
+
+    def flush(self):
+        self.slots.write(self.slot, self.result)
+
+    def flush_groups(self):
+        if not self.result.groups and not self.result.worker_loads:
+            return
+        groups = LoadResult()
+        groups.groups, groups.worker_loads = self.result.groups, self.result.worker_loads
+        self.result.groups, self.result.worker_loads = {}, {}
+        self.output.write(SubCmd(SubCmd.CmdResult, groups).msg())
+
+    def close(self, callback):
+        for timer in self.timers:
+            timer.stop()
+        self.flush()
+        self.flush_groups()
+        future = self.output.write(SubCmd(SubCmd.CmdExit).msg())
+        tornado.ioloop.IOLoop.current().add_future(future, lambda f: callback())
+
+class _Crc32(object):
+    """crc32 with the update/hexdigest interface of hashlib."""
+    def __init__(self):
+        self.crc = 0
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+
+    def hexdigest(self):
+        return '{:08x}'.format(self.crc & 0xffffffff)
+
+class BodyExpectation(object):
+    """What every response body is checked against in --stream mode, any
+    of size, hash and substring may be None."""
+    def __init__(self, args):
+        self.size = args.expect_size
+        self.hash_name = self.hash_value = None
+        if args.expect_hash:
+            self.hash_name, self.hash_value = args.expect_hash.split(':', 1)
+            self.hash_value = self.hash_value.lower()
+        self.substring = args.expect_substring
+        if self.substring is not None and not isinstance(self.substring, bytes):
+            self.substring = self.substring.encode('utf-8')
+
+    def new_hash(self):
+        if self.hash_name is None:
+            return None
+        if self.hash_name == 'crc32':
+            return _Crc32()
+        return hashlib.new(self.hash_name)
+
+class BodyCheck(object):
+    """Checks one response body chunk by chunk, the body is never kept.
+
+    For the substring only its length - 1 last bytes are carried over to
+    the next chunk, so a match spanning chunks is still found.
+    """
+    def __init__(self, expect):
+        self.expect = expect
+        self.size = 0
+        self.hash = expect.new_hash()
+        self.found = expect.substring is None
+        self.tail = b''
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.hash is not None:
+            self.hash.update(chunk)
+        if not self.found:
+            substring = self.expect.substring
+            data = self.tail + chunk
+            if substring in data:
+                self.found = True
+                self.tail = b''
+            else:
+                self.tail = data[len(data) - len(substring) + 1:] if len(substring) > 1 else b''
+
+    def ok(self):
+        expect = self.expect
+        if expect.size is not None and self.size != expect.size:
+            return False
+        if self.hash is not None and self.hash.hexdigest() != expect.hash_value:
+            return False
+        return self.found
+
+class _ResponseCollector(tornado.httputil.HTTPMessageDelegate):
+    def __init__(self, streaming_callback=None):
+        self.start_line = None
+        self.headers = None
+        self.chunks = []
+        self.headers_time = None
+        self.streaming_callback = streaming_callback
+
+    def headers_received(self, start_line, headers):
+        self.start_line = start_line
+        self.headers = headers
+        self.headers_time = time.time()
+
+    def data_received(self, chunk):
+        if self.streaming_callback is not None:
+            self.streaming_callback(chunk)
+        else:
+            self.chunks.append(chunk)
+
+class KeepAliveClient(object):
+    """Minimal HTTP/1.1 client which keeps connections open between requests.
+
+    One instance is shared by all the Requests of a worker, since every
+    Request has at most one fetch in flight the pool never grows beyond the
+    concurrency (-c) of the worker. Timeouts and redirects default to those
+    of AsyncHTTPClient, an expired timeout fails the request with 599.
+    """
+    CONNECT_TIMEOUT = 20
+    REQUEST_TIMEOUT = 20
+    MAX_REDIRECTS = 5
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+    def __init__(self):
+        self.tcp_client = tornado.tcpclient.TCPClient()
+        self.conn_params = tornado.http1connection.HTTP1ConnectionParameters(decompress=False)
+        self.idle_streams = collections.defaultdict(list)
+
+    def close(self):
+        for streams in self.idle_streams.values():
+            for stream in streams:
+                stream.close()
+        self.idle_streams.clear()
+        self.tcp_client.close()
+
+    @staticmethod
+    def _close_late_stream(future):
+        # the connection came after its timeout
+        if future.exception() is None:
+            future.result().close()
+
+    @tornado.gen.coroutine
+    def _get_stream(self, parsed, deadline):
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        streams = self.idle_streams[key]
+        while streams:
+            stream = streams.pop()
+            if not stream.closed():
+                raise tornado.gen.Return((key, stream, None))
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        ssl_options = None
+        if parsed.scheme == 'https':
+            ssl_options = {'cert_reqs': ssl.CERT_NONE}
+        connect_start = time.time()
+        connect = self.tcp_client.connect(parsed.hostname, port, ssl_options=ssl_options)
+        try:
+            stream = yield tornado.gen.with_timeout(deadline, connect, quiet_exceptions=(
+                tornado.iostream.StreamClosedError, socket.error, ssl.SSLError))
+        except tornado.gen.TimeoutError:
+            tornado.ioloop.IOLoop.current().add_future(connect, self._close_late_stream)
+            raise tornado.httpclient.HTTPError(599, 'Timeout while connecting')
+        stream.set_nodelay(True)
+        # the connect time, None for a reused stream
+        raise tornado.gen.Return((key, stream, time.time() - connect_start))
+
+    @tornado.gen.coroutine
+    def _fetch(self, request):
+        start_time = time.time()
+        loop_start = tornado.ioloop.IOLoop.current().time()
+        request_deadline = loop_start + (request.request_timeout or self.REQUEST_TIMEOUT)
+        connect_deadline = min(request_deadline, loop_start + (request.connect_timeout or self.CONNECT_TIMEOUT))
+        parsed = urlparse.urlsplit(request.url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        headers = tornado.httputil.HTTPHeaders(request.headers)
+        if 'Host' not in headers:
+            headers['Host'] = parsed.netloc
+        start_line = tornado.httputil.RequestStartLine(request.method, path, 'HTTP/1.1')
+        while True:
+            key, stream, connect_time = yield self._get_stream(parsed, connect_deadline)
+            reused = connect_time is None
+            conn = tornado.http1connection.HTTP1Connection(stream, True, self.conn_params)
+            collector = _ResponseCollector(request.streaming_callback)
+            try:
+                conn.write_headers(start_line, headers)
+                if request.body:
+                    conn.write(request.body)
+                conn.finish()
+                sent_time = time.time()
+                yield tornado.gen.with_timeout(request_deadline, conn.read_response(collector),
+                                               quiet_exceptions=tornado.iostream.StreamClosedError)
+            except tornado.gen.TimeoutError:
+                stream.close()
+                raise tornado.httpclient.HTTPError(599, 'Timeout during request')
+            except tornado.iostream.StreamClosedError:
+                # the server may drop an idle connection at any time, retry
+                # on a fresh one unless the response had already begun
+                if reused and collector.start_line is None:
+                    continue
+                raise
+            break
+        if collector.start_line is None:
+            raise tornado.iostream.StreamClosedError()
+        if not stream.closed():
+            self.idle_streams[key].append(stream)
+        end_time = time.time()
+        response = tornado.httpclient.HTTPResponse(
+            request, collector.start_line.code, headers=collector.headers,
+            buffer=BytesIO(b''.join(collector.chunks)),
+            reason=collector.start_line.reason,
+            request_time=end_time - start_time)
+        response.reused_conn = reused
+        response.phases = (connect_time, collector.headers_time - sent_time, end_time - collector.headers_time)
+        max_redirects = self.MAX_REDIRECTS if request.max_redirects is None else request.max_redirects
+        if (request.follow_redirects is not False and response.code in self.REDIRECT_CODES
+                and max_redirects > 0 and 'Location' in response.headers):
+            response = yield self._follow(request, response, max_redirects)
+            response.request_time = time.time() - start_time
+        raise tornado.gen.Return(response)
+
+    def _follow(self, request, response, max_redirects):
+        """Fetches the target of a redirect response, the way AsyncHTTPClient
+        does: 303, and 301/302 of a POST, turn into a GET without body."""
+        new_request = copy.copy(request)
+        new_request.url = urlparse.urljoin(request.url, response.headers['Location'])
+        new_request.max_redirects = max_redirects - 1
+        new_request.headers = tornado.httputil.HTTPHeaders(request.headers)
+        # the Host of the original url must not go along
+        new_request.headers.pop('Host', None)
+        if response.code == 303 or (response.code in (301, 302) and request.method == 'POST'):
+            new_request.method = 'GET'
+            new_request.body = None
+            for name in ('Content-Length', 'Content-Type', 'Content-Encoding', 'Transfer-Encoding'):
+                new_request.headers.pop(name, None)
+        return self._fetch(new_request)
+
+    def fetch(self, request, callback):
+        if not isinstance(request, tornado.httpclient.HTTPRequest):
+            request = tornado.httpclient.HTTPRequest(request)
+        start_time = time.time()
+        def on_fetched(future):
+            try:
+                response = future.result()
+            except Exception as e:
+                response = tornado.httpclient.HTTPResponse(
+                    request, 599, error=e, request_time=time.time() - start_time)
+            callback(response)
+        tornado.ioloop.IOLoop.current().add_future(self._fetch(request), on_fetched)
+
+class Scenario(object):
+    """Request definitions read lazily from a scenario file, one per line.
+
+    A line is either a json object like
+        {"method": "POST", "url": "/api", "headers": {}, "body": "", "weight": 1, "group": "api"}
+    where everything but url is optional, or a common log format access log
+    line, of which only method and path are used. Relative urls are joined
+    to the base url. Empty lines and lines starting with # are skipped.
+    """
+    CLF_REGEX = re.compile(r'^\S+ \S+ \S+ \[[^\]]+\] "(?P<method>[A-Z]+) (?P<path>\S+)[^"]*"')
+
+    def __init__(self, path, base_url):
+        self.path = path
+        self.base_url = base_url
+
+    def _parse_line(self, line):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            return None
+        if line.startswith('{'):
+            entry = json.loads(line)
+            method = entry.get('method', 'GET').upper()
+            url = entry['url']
+            headers = entry.get('headers')
+            body = entry.get('body')
+            weight = float(entry.get('weight', 1))
+            group = entry.get('group')
+        else:
+            match = self.CLF_REGEX.match(line)
+            if not match:
+                return None
+            method = match.group('method')
+            url = match.group('path')
+            headers = body = group = None
+            weight = 1.0
+        url = urlparse.urljoin(self.base_url, url)
+        if group is None:
+            group = urlparse.urlsplit(url).path or '/'
+        return (method, url, headers, body, weight, group)
+
+    def entries(self, worker_id=0, num_workers=1):
+        """Yield (method, url, headers, body, weight, group) of the requests
+        belonging to this worker, the requests are dealt round robin, so
+        skipped lines do not unbalance the workers."""
+        index = 0
+        with open(self.path) as f:
+            for line in f:
+                entry = self._parse_line(line)
+                if entry is None:
+                    continue
+                if index % num_workers == worker_id:
+                    yield entry
+                index += 1
+
+    @staticmethod
+    def build_request(method, url, headers, body):
+        return tornado.httpclient.HTTPRequest(
+            url, method=method, headers=headers, body=body,
+            allow_nonstandard_methods=True)
+
+class SingleUrlSource(object):
+    def __init__(self, url):
+        self.request = tornado.httpclient.HTTPRequest(url)
+
+    def next(self):
+        return self.request, None
+
+class WeightedSource(object):
+    """Picks scenario requests at random by weight. Identical lines are
+    folded into one entry, so only distinct requests are kept and all of
+    them are built once up front.
+
+    Of a file longer than MAX_LINES a uniform sample of MAX_LINES lines is
+    kept (reservoir sampling), picking by weight among it still picks every
+    line in proportion to its weight, frequent lines just get folded.
+    """
+    MAX_LINES = 20000
+
+    def __init__(self, scenario):
+        sample = []
+        for n, entry in enumerate(scenario.entries()):
+            if n < self.MAX_LINES:
+                sample.append(entry)
+            else:
+                i = random.randint(0, n)
+                if i < self.MAX_LINES:
+                    sample[i] = entry
+        index = {}
+        weights = []
+        self.requests = []
+        self.groups = []
+        for method, url, headers, body, weight, group in sample:
+            key = (method, url, body, group,
+                   tuple(sorted(headers.items())) if headers else None)
+            if key not in index:
+                index[key] = len(weights)
+                weights.append(0.0)
+                self.requests.append(Scenario.build_request(method, url, headers, body))
+                self.groups.append(group)
+            weights[index[key]] += weight
+        if not weights:
+            raise ValueError('no request in scenario file {}'.format(scenario.path))
+        self.cum_weights = []
+        total = 0.0
+        for w in weights:
+            total += w
+            self.cum_weights.append(total)
+        self.total_weight = total
+
+    def next(self):
+        i = bisect.bisect_right(self.cum_weights, random.random() * self.total_weight)
+        i = min(i, len(self.requests) - 1)
+        return self.requests[i], self.groups[i]
+
+class ReplaySource(object):
+    """Replays this worker's share of the scenario requests in order, starting
+    over at the end of the file.
+
+    Requests are built READ_AHEAD at a time. A share of at most
+    MAX_CACHED requests is built once and replayed from memory, a larger one
+    is streamed again on every pass, the file is never loaded whole.
+    """
+    READ_AHEAD = 1000
+    MAX_CACHED = 20000
+
+    def __init__(self, scenario, worker_id, num_workers):
+        self.scenario = scenario
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.entries = None
+        self.chunk = []
+        self.pos = 0
+        # requests of the first pass, None once there are too many to keep
+        self.first_pass = []
+        self.cached = None
+
+    def next(self):
+        if self.pos == len(self.chunk):
+            self.chunk = self._next_chunk()
+            self.pos = 0
+        self.pos += 1
+        return self.chunk[self.pos - 1]
+
+    def _next_chunk(self):
+        if self.cached is not None:
+            return self.cached
+        for restarted in (False, True):
+            if self.entries is None:
+                self.entries = self.scenario.entries(self.worker_id, self.num_workers)
+            chunk = [(Scenario.build_request(method, url, headers, body), group)
+                     for method, url, headers, body, weight, group in itertools.islice(self.entries, self.READ_AHEAD)]
+            if chunk:
+                if self.first_pass is not None:
+                    self.first_pass.extend(chunk)
+                    if len(self.first_pass) > self.MAX_CACHED:
+                        self.first_pass = None
+                return chunk
+            self.entries = None
+            if self.first_pass:
+                # the whole share fits, no more reading and parsing
+                self.cached = self.first_pass
+                return self.cached
+        raise ValueError('no request in scenario file {} for worker {}'.format(
+            self.scenario.path, self.worker_id))
+
+def make_request_source(args, worker_id):
+    if not args.scenario:
+        return SingleUrlSource(args.url)
+    scenario = Scenario(args.scenario, args.url)
+    if args.scenario_mode == 'replay':
+        return ReplaySource(scenario, worker_id, args.procs)
+    return WeightedSource(scenario)
+
+class RateScheduler(object):
+    """Open-loop scheduler which sends requests on a fixed timeline.
+
+    Due requests are handed to idle Requests, when all of them are busy the
+    due requests queue up. Queued requests always have consecutive send
+    times, so the queue is just a counter plus the time of its head.
+    """
+    TICK = 0.001
+
+    def __init__(self, rate, worker, start_offset=0):
+        self.loop = tornado.ioloop.IOLoop.current()
+        self.interval = 1.0 / rate
+        self.worker = worker
+        self.start_offset = start_offset
+        self.requests = []
+        self.idle = []
+        self.next_time = None
+        self.num_queued = 0
+        self.queue_head_time = None
+
+    def add(self, request):
+        self.requests.append(request)
+        self.idle.append(request)
+
+    def start(self):
+        self.next_time = self.loop.time() + self.start_offset
+        self._tick()
+
+    def _tick(self):
+        now = self.loop.time()
+        while self.next_time <= now:
+            if not self.worker.can_send():
+                # busy requests end the worker once they are done
+                self.num_queued = 0
+                self.worker.try_finish()
+                return
+            self._dispatch(self.next_time)
+            self.next_time += self.interval
+        self.loop.call_at(max(self.next_time, now + self.TICK), self._tick)
+
+    def _dispatch(self, send_time):
+        if self.idle:
+            self.idle.pop().run(send_time)
+            return
+        if self.num_queued == 0:
+            self.queue_head_time = send_time
+        self.num_queued += 1
+
+    def set_rate(self, rate):
+        self.interval = 1.0 / rate
+
+    def stop(self):
+        """The queued requests were due before the stop and are never sent,
+        they are counted as dropped."""
+        if self.num_queued and self.loop.time() >= self.worker.warmup_end:
+            self.worker.reporter.result.num_dropped += self.num_queued
+        self.num_queued = 0
+
+    def on_done(self, request):
+        if self.num_queued and self.worker.can_send():
+            send_time = self.queue_head_time
+            self.num_queued -= 1
+            self.queue_head_time += self.interval
+            request.run(send_time)
+        else:
+            self.idle.append(request)
+
+def split_share(total, num_parts, index):
+    """Share of part index when total is split as evenly as possible."""
+    return total // num_parts + (1 if index < total % num_parts else 0)
+
+class LoadMonitor(object):
+    """Samples the event loop lag and CPU usage of the worker process.
+
+    A callback is scheduled every LAG_INTERVAL ms, how late it runs is the
+    loop lag. Every SAMPLE_INTERVAL ms the worst lag and the CPU time used
+    meanwhile are put into the result of the reporter.
+    """
+    LAG_INTERVAL = 0.05
+    SAMPLE_INTERVAL = 1.0
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.loop = worker.loop
+        self.name = '{}/{}'.format(socket.gethostname(), os.getpid())
+        self.max_lag = 0.0
+        self.load = None
+        self.sample_time = self.loop.time()
+        self.cpu_time = self._cpu_time()
+        self.timeout = None
+
+    @staticmethod
+    def _cpu_time():
+        times = os.times()
+        return times[0] + times[1]
+
+    def start(self):
+        self.expected = self.loop.time() + self.LAG_INTERVAL
+        self.timeout = self.loop.call_at(self.expected, self._tick)
+
+    def stop(self):
+        if self.timeout is not None:
+            self.loop.remove_timeout(self.timeout)
+            self.timeout = None
+            # account the time since the last sample too
+            now = self.loop.time()
+            if now > self.sample_time:
+                self._sample(now)
+
+    def _tick(self):
+        now = self.loop.time()
+        self.max_lag = max(self.max_lag, now - self.expected)
+        if now - self.sample_time >= self.SAMPLE_INTERVAL:
+            self._sample(now)
+        self.expected = now + self.LAG_INTERVAL
+        self.timeout = self.loop.call_at(self.expected, self._tick)
+
+    def _sample(self, now):
+        cpu_time = self._cpu_time()
+        cpu = (cpu_time - self.cpu_time) / (now - self.sample_time) * 100
+        load = WorkerLoad(self.max_lag * 1000, cpu)
+        if self.load is not None:
+            load.peak_loop_lag, load.peak_cpu = self.load.peak_loop_lag, self.load.peak_cpu
+            load.num_samples, load.num_saturated = self.load.num_samples, self.load.num_saturated
+            load.cpu_time = self.load.cpu_time
+        if now >= self.worker.warmup_end:
+            load.cpu_time += cpu_time - self.cpu_time
+            load.peak_loop_lag = max(load.peak_loop_lag, load.loop_lag)
+            load.peak_cpu = max(load.peak_cpu, load.cpu)
+            load.num_samples += 1
+            load.num_saturated += 1 if load.saturated() else 0
+        self.load = load
+        self.worker.reporter.result.worker_loads[self.name] = load
+        self.sample_time = now
+        self.cpu_time = cpu_time
+        self.max_lag = 0.0
+
+class Worker(object):
+    """Keeps the requests of a worker process going and stops them cleanly.
+
+    After stop(), or once the --requests quota of this worker has been
+    sent, no new request goes out, the ones in flight are waited for (at
+    most DRAIN_TIMEOUT seconds), then the final result is flushed to the
+    parent and the loop stops. Requests sent during the warm-up are not
+    recorded.
+    """
+    DRAIN_TIMEOUT = 10
+
+    def __init__(self, args, worker_id, reporter):
+        self.loop = tornado.ioloop.IOLoop.current()
+        self.args = args
+        self.reporter = reporter
+        self.scheduler = None
+        # closed-loop concurrency in requests, see set_load()
+        self.new_requests = None
+        self.requests_per_unit = args.pipeline if args.engine == 'asyncio' else 1
+        self.concurrency = 0
+        self.num_retiring = 0
+        # None is no limit, a share of 0 sends nothing
+        self.quota = split_share(args.requests, args.procs, worker_id) if args.requests is not None else None
+        self.warmup_end = self.loop.time() + args.warmup
+        self.num_sent = 0
+        self.num_inflight = 0
+        self.stopping = False
+        self.finished = False
+        self.expect = BodyExpectation(args) if args.stream else None
+        self.monitor = LoadMonitor(self)
+        self.monitor.start()
+
+    def can_send(self):
+        return not self.stopping and (self.quota is None or self.num_sent < self.quota)
+
+    def on_send(self):
+        """Called for every request sent, returns whether it is recorded."""
+        self.num_inflight += 1
+        if self.loop.time() < self.warmup_end:
+            return False
+        self.num_sent += 1
+        return True
+
+    def start(self, new_requests):
+        """new_requests(n) creates the requests of n more units of -c."""
+        self.new_requests = new_requests
+        if not self.can_send():
+            # --requests is smaller than the number of workers
+            self.finish()
+            return
+        requests = new_requests(self.args.coroutines)
+        self.concurrency = len(requests)
+        if self.scheduler is not None:
+            for r in requests:
+                self.scheduler.add(r)
+            self.scheduler.start()
+        else:
+            self._run(requests)
+
+    def _run(self, requests):
+        for r in requests:
+            if self.can_send():
+                r.run()
+
+    def set_load(self, load):
+        """Changes -c of this worker, or its rate in open-loop mode. Surplus
+        requests retire as they complete."""
+        if self.scheduler is not None:
+            self.scheduler.set_rate(load)
+            return
+        target = int(load) * self.requests_per_unit
+        delta = target - self.concurrency
+        self.concurrency = target
+        if delta < 0:
+            self.num_retiring -= delta
+            return
+        # requests about to retire may just keep going
+        kept = min(delta, self.num_retiring)
+        self.num_retiring -= kept
+        delta -= kept
+        if delta:
+            self._run(self.new_requests(-(-delta // self.requests_per_unit)))
+
+    def on_done(self, request):
+        self.num_inflight -= 1
+        if not self.can_send():
+            self.try_finish()
+        elif self.num_retiring:
+            self.num_retiring -= 1
+        elif self.scheduler is not None:
+            self.scheduler.on_done(request)
+        else:
+            request.run()
+
+    def stop(self):
+        if self.stopping:
+            return
+        self.stopping = True
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        self.loop.call_later(self.DRAIN_TIMEOUT, self.finish)
+        self.try_finish()
+
+    def try_finish(self):
+        if self.num_inflight == 0:
+            self.finish()
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.monitor.stop()
+        self.reporter.close(self.loop.stop)
+
+class Request(object):
+    def __init__(self, source, worker, client=None):
+        self.source = source
+        self.group = None
+        self.worker = worker
+        self.recorded = False
+        # a shared keep-alive client, otherwise every fetch uses a new one
+        self.shared_client = client
+        self.client = client
+        # only set in open-loop mode, see RateScheduler
+        self.intended_time = None
+        self.send_time = None
+        # body bytes of the response, checked by self.check in --stream mode
+        self.num_bytes = 0
+        self.check = None
+
+    @staticmethod
+    def _phases(response):
+        """(connect, ttfb, transfer) seconds of a response, an item is None if
+        unknown. KeepAliveClient measures them itself, curl_httpclient fills
+        time_info, simple_httpclient provides none."""
+        phases = getattr(response, 'phases', None)
+        if phases is not None:
+            return phases
+        info = response.time_info
+        if 'starttransfer' not in info:
+            return None
+        # curl times are cumulative from the start of the request
+        connected = info.get('appconnect') or info['connect']
+        return (connected or None, info['starttransfer'] - info['pretransfer'],
+                info['total'] - info['starttransfer'])
 
     def handle_response(self, response):
-        self.result.num_requests += 1
-        if response.body is None or response.error:
-            self.result.num_errors += 1
-        self.result.new_status(response.code)
-        resp_time = response.request_time * 1000
-        self.result.total_resp_time += resp_time
-        self.result.avg_resp_time = self.result.total_resp_time / self.result.num_requests
-        self.result.min_resp_time = min(self.result.min_resp_time, resp_time)
-        self.result.max_resp_time = max(self.result.max_resp_time, resp_time)
-
-        if self.result.num_requests % 10 == 0:
-            self.output.write(SubCmd(SubCmd.CmdResult, self.result).msg())
-            self.result = LoadResult()
-
-        self.client.close()
-        global now_exit
-        if not now_exit:
-            self.run()
+        if self.shared_client is None:
+            self.client.close()
+        if self.check is None and response.body is not None:
+            self.num_bytes = len(response.body)
+        self.finish(response.code, response.body is None or response.error is not None,
+                    response.request_time, getattr(response, 'reused_conn', False),
+                    self._phases(response) if response.error is None else None)
+
+    def finish(self, code, failed, request_time, reused_conn, phases=None):
+        if self.recorded:
+            self.record(code, failed, request_time, reused_conn, phases)
+        self.worker.on_done(self)
+
+    def record(self, code, failed, request_time, reused_conn, phases=None):
+        result = self.worker.reporter.result
+        result.num_requests += 1
+        if failed:
+            result.num_errors += 1
+        result.new_status(code)
+        if self.check is not None:
+            self.num_bytes = self.check.size
+            if not failed and not self.check.ok():
+                failed = True
+                result.num_errors += 1
+                result.num_invalid += 1
+        result.num_bytes += self.num_bytes
+        if reused_conn:
+            result.num_reused_conns += 1
+        else:
+            result.num_new_conns += 1
+        # microseconds
+        if self.intended_time is not None:
+            # measure from the scheduled send time, otherwise a slow server
+            # hides the requests it has delayed (coordinated omission)
+            now = tornado.ioloop.IOLoop.current().time()
+            resp_time = (now - self.intended_time) * 1000000
+            result.sched_lag_hist.record((self.send_time - self.intended_time) * 1000000)
         else:
-            tornado.ioloop.IOLoop.current().stop()
-            sys.exit(0)
+            resp_time = request_time * 1000000
+        result.resp_hist.record(resp_time)
+        if phases is not None:
+            for hist_name, phase_time in zip(LoadResult.PHASE_HISTOGRAMS, phases):
+                if phase_time is not None:
+                    getattr(result, hist_name).record(phase_time * 1000000)
+        if self.group is not None:
+            group = result.group(self.group)
+            group.num_requests += 1
+            if failed:
+                group.num_errors += 1
+            group.resp_hist.record(resp_time)
+        self.worker.reporter.on_response()
 
-    def run(self):
-        self.client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
-        self.client.fetch(self.url, self.handle_response)
+    def run(self, intended_time=None):
+        self.recorded = self.worker.on_send()
+        self.intended_time = intended_time
+        self.send_time = tornado.ioloop.IOLoop.current().time()
+        self.num_bytes = 0
+        if self.worker.expect is not None:
+            self.check = BodyCheck(self.worker.expect)
+        self.fetch()
+
+    def fetch(self):
+        if self.shared_client is None:
+            self.client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+        request, self.group = self.source.next()
+        if self.check is not None:
+            # sources hand out shared request objects
+            request = copy.copy(request)
+            request.streaming_callback = self.check.feed
+        self.client.fetch(request, self.handle_response)
+
+class RawRequest(Request):
+    """Request of the raw asyncio engine, sent over the connection of its
+    lane. request_time is measured from the moment it was written, with
+    pipelining the time to first byte includes waiting for the responses
+    ahead of it."""
+    def __init__(self, source, worker, lane):
+        super(RawRequest, self).__init__(source, worker)
+        self.lane = lane
+        self.raw = None
+        self.method = None
+        self.write_time = None
+        self.connect_time = None
+        self.first_byte_time = None
+
+    def fetch(self):
+        request, self.group = self.source.next()
+        # encode once per request object, static sources hand out the same ones
+        raw = getattr(request, 'raw_bytes', None)
+        if raw is None:
+            raw = request.raw_bytes = encode_request(request)
+        self.raw = raw
+        self.method = request.method
+        self.lane.send(self)
+
+    def on_response(self, code, failed, reused_conn):
+        now = self.lane.loop.time()
+        phases = None
+        if not failed and self.first_byte_time is not None:
+            phases = (self.connect_time, self.first_byte_time - self.write_time, now - self.first_byte_time)
+        self.connect_time = self.first_byte_time = None
+        self.finish(code, failed, now - self.write_time, reused_conn, phases)
+
+def encode_request(request):
+    parsed = urlparse.urlsplit(request.url)
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+    lines = ['{} {} HTTP/1.1'.format(request.method, path), 'Host: {}'.format(parsed.netloc)]
+    # scenario requests keep the plain dict they were given
+    for k, v in tornado.httputil.HTTPHeaders(request.headers).get_all():
+        if k.lower() not in ('host', 'content-length'):
+            lines.append('{}: {}'.format(k, v))
+    body = request.body or b''
+    if body or request.method in ('POST', 'PUT', 'PATCH'):
+        lines.append('Content-Length: {}'.format(len(body)))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+class RawHTTPProtocol(asyncio.Protocol if asyncio is not None else object):
+    """asyncio protocol of one connection of the raw engine.
+
+    Requests are written as pre-encoded bytes, responses are matched to
+    them in order, and only the status line plus what is needed to find
+    the end of the body (Content-Length, chunked, Connection: close) is
+    parsed. Bodies are skipped, never stored. While the transport buffer
+    is above its high-water mark, requests wait to be written. A response
+    not complete REQUEST_TIMEOUT seconds after its request was written fails
+    the connection, with a 599 for every request on it.
+    """
+    REQUEST_TIMEOUT = KeepAliveClient.REQUEST_TIMEOUT
+
+    def __init__(self, lane):
+        self.lane = lane
+        self.transport = None
+        self.closed = False
+        self.paused = False
+        self.waiting = []
+        self.pending = collections.deque()
+        self.num_sent = 0
+        self.buf = bytearray()
+        self.connect_start = lane.loop.time()
+        self.connect_time = None
+        self.first_byte_time = None
+        self.timeout = None
+        self._reset_response()
+
+    def _reset_timeout(self):
+        """Times the response of the oldest request in flight."""
+        if self.timeout is not None:
+            self.timeout.cancel()
+            self.timeout = None
+        if self.pending and not self.closed:
+            self.timeout = self.lane.loop.call_at(
+                self.pending[0].write_time + self.REQUEST_TIMEOUT, self.fail)
+
+    def _reset_response(self):
+        self.code = None
+        self.body_left = 0
+        self.chunked = False
+        self.chunk_left = 0
+        self.in_trailer = False
+        self.close_after = False
+
+    def send(self, req):
+        if self.transport is None or self.paused:
+            self.waiting.append(req)
+            return
+        req.reused = self.num_sent > 0
+        if not req.reused:
+            req.connect_time = self.connect_time
+        self.num_sent += 1
+        req.write_time = self.lane.loop.time()
+        self.pending.append(req)
+        if len(self.pending) == 1:
+            self._reset_timeout()
+        self.transport.write(req.raw)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connect_time = self.lane.loop.time() - self.connect_start
+        self._send_waiting()
+
+    def _send_waiting(self):
+        waiting, self.waiting = self.waiting, []
+        for req in waiting:
+            self.send(req)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._send_waiting()
+
+    def connection_lost(self, exc):
+        self.fail()
+
+    def eof_received(self):
+        if self.code is not None and self.body_left < 0:
+            # body delimited by connection close
+            self._finish_response()
+        return False
+
+    def fail(self):
+        """Fails every request on this connection, they are retried on a new
+        one by the lane."""
+        if self.closed:
+            return
+        self.closed = True
+        self._reset_timeout()
+        if self.transport is not None:
+            self.transport.close()
+        self.lane.on_closed(self)
+        failed = list(self.pending) + self.waiting
+        self.pending.clear()
+        self.waiting = []
+        for req in failed:
+            if req.write_time is None:
+                req.write_time = self.lane.loop.time()
+            req.on_response(599, True, getattr(req, 'reused', False))
+
+    def data_received(self, data):
+        if self.first_byte_time is None:
+            self.first_byte_time = self.lane.loop.time()
+        self.buf += data
+        try:
+            while self.pending and self._parse():
+                self._finish_response()
+        except ValueError:
+            # malformed response
+            self.fail()
+
+    def _parse(self):
+        buf = self.buf
+        if self.code is None:
+            end = buf.find(b'\r\n\r\n')
+            if end < 0:
+                return False
+            head = bytes(buf[:end]).lower()
+            del buf[:end + 4]
+            self.code = int(head[9:12])
+            self.close_after = (b'\r\nconnection: close' in head or
+                                (head.startswith(b'http/1.0') and b'\r\nconnection: keep-alive' not in head))
+            if (self.pending[0].method == 'HEAD' or self.code in (204, 304) or
+                    100 <= self.code < 200):
+                self.body_left = 0
+            elif b'\r\ntransfer-encoding: chunked' in head:
+                self.chunked = True
+            else:
+                pos = head.find(b'\r\ncontent-length:')
+                if pos >= 0:
+                    pos += len(b'\r\ncontent-length:')
+                    line_end = head.find(b'\r\n', pos)
+                    self.body_left = int(head[pos:line_end if line_end >= 0 else len(head)])
+                else:
+                    self.body_left = -1
+        if self.chunked:
+            return self._parse_chunks()
+        if self.body_left < 0:
+            self._body_data(len(buf))
+            del buf[:]
+            return False
+        n = min(len(buf), self.body_left)
+        self._body_data(n)
+        del buf[:n]
+        self.body_left -= n
+        return self.body_left == 0
+
+    def _parse_chunks(self):
+        buf = self.buf
+        while True:
+            if self.chunk_left:
+                # chunk data and its trailing CRLF
+                n = min(len(buf), self.chunk_left)
+                self._body_data(min(n, self.chunk_left - 2))
+                del buf[:n]
+                self.chunk_left -= n
+                if self.chunk_left:
+                    return False
+            end = buf.find(b'\r\n')
+            if end < 0:
+                return False
+            line = bytes(buf[:end])
+            del buf[:end + 2]
+            if self.in_trailer:
+                if not line:
+                    return True
+                continue
+            size = int(line.split(b';')[0], 16)
+            if size == 0:
+                self.in_trailer = True
+            else:
+                self.chunk_left = size + 2
+
+    def _body_data(self, n):
+        """Accounts the first n bytes of the buffer as body of the current
+        response, they are only copied when the body is checked."""
+        if n <= 0:
+            return
+        req = self.pending[0]
+        req.num_bytes += n
+        if req.check is not None:
+            req.check.feed(bytes(self.buf[:n]))
+
+    def _finish_response(self):
+        req = self.pending.popleft()
+        req.first_byte_time = self.first_byte_time
+        # what is left in the buffer already belongs to the next response
+        self.first_byte_time = self.lane.loop.time() if self.buf else None
+        code = self.code
+        close_after = self.close_after
+        self._reset_response()
+        unanswered = []
+        if close_after:
+            self.closed = True
+            self.transport.close()
+            self.lane.on_closed(self)
+            # pipelined requests behind a closing response were not served,
+            # send them again on a new connection
+            unanswered = list(self.pending)
+            self.pending.clear()
+        self._reset_timeout()
+        req.on_response(code, code < 200 or code >= 300, req.reused)
+        for r in unanswered:
+            self.lane.send(r)
+
+class RawHTTPLane(object):
+    """One connection slot of the raw engine carrying `pipeline` requests at
+    a time, the connection is reopened whenever the server closes it. A
+    connect taking longer than CONNECT_TIMEOUT fails its requests."""
+    CONNECT_TIMEOUT = KeepAliveClient.CONNECT_TIMEOUT
+
+    def __init__(self, loop, host, port, ssl_context):
+        self.loop = loop
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.protocol = None
+
+    def send(self, req):
+        if self.protocol is None:
+            protocol = self.protocol = RawHTTPProtocol(self)
+            connect = self.loop.create_connection(
+                lambda: protocol, self.host, self.port, ssl=self.ssl_context)
+            future = asyncio.ensure_future(asyncio.wait_for(connect, self.CONNECT_TIMEOUT), loop=self.loop)
+            future.add_done_callback(functools.partial(self._on_connected, protocol))
+        self.protocol.send(req)
+
+    def _on_connected(self, protocol, future):
+        if future.cancelled() or future.exception() is not None:
+            protocol.fail()
+
+    def on_closed(self, protocol):
+        if self.protocol is protocol:
+            self.protocol = None
+
+def start_raw_engine(args, source, worker, num_lanes):
+    """Creates num_lanes lanes of the raw engine, each with --pipeline
+    requests."""
+    loop = tornado.ioloop.IOLoop.current().asyncio_loop
+    parsed = urlparse.urlsplit(args.url)
+    ssl_context = None
+    if parsed.scheme == 'https':
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    requests = []
+    for n in range(num_lanes):
+        lane = RawHTTPLane(loop, parsed.hostname, port, ssl_context)
+        for m in range(args.pipeline):
+            requests.append(RawRequest(source, worker, lane))
+    return requests
+
+def hashlib_algorithms():
+    # algorithms_available is python2.7.9+/3.2+
+    return getattr(hashlib, 'algorithms_available', None) or hashlib.algorithms
+
+def parse_procs(value):
+    # 0 stands for auto, resolved where the workers run
+    if value == 'auto':
+        return 0
+    procs = int(value)
+    if procs < 1:
+        raise argparse.ArgumentTypeError(u'进程数目至少为1')
+    return procs
 
 def parse_cmd_args():
     parser = argparse.ArgumentParser(description=u'Http压力测试工具')
-    parser.add_argument('url', help=u'目标URL')
-    parser.add_argument('-f', dest='procs', type=int, default=1, help=u'进程数目，默认1')
+    parser.add_argument('url', nargs='?', help=u'目标URL，使用--scenario时为相对URL的基准URL')
+    parser.add_argument('-f', dest='procs', type=parse_procs, default=1,
+                        help=u'进程数目，auto为可用的CPU核数，默认1')
+    parser.add_argument('--cpu-affinity', dest='cpu_affinity', metavar='CPUS', nargs='?', const='all',
+                        help=u'将各进程依次绑定到这些CPU上(如0-3,6)，不指定CPU时使用所有可用的CPU')
     parser.add_argument('-c', dest='coroutines', type=int, default=10, help=u'每个进程(单线程)的并发数目，默认10')
+    parser.add_argument('-k', dest='keepalive', action='store_true', help=u'使用HTTP Keep-Alive复用连接，每个进程最多保持-c个连接。'
+                             u'和默认方式一样，连接和请求超时均为20秒(计为599错误)，最多跟随5次重定向')
+    parser.add_argument('--engine', choices=('tornado', 'asyncio'), default='tornado',
+                        help=u'tornado: 使用tornado的AsyncHTTPClient；asyncio: 使用预先编码的请求和极简的响应解析，总是保持连接，'
+                             u'单核能产生更大的压力(需要python3)，所有请求都发往url参数中的主机。默认tornado')
+    parser.add_argument('--pipeline', type=int, default=1,
+                        help=u'asyncio引擎每个连接同时发送的请求数(HTTP pipelining)，默认1')
+    parser.add_argument('--rate', dest='rate', type=float, default=0,
+                        help=u'开环模式，按固定速率(所有进程合计，#/s)发送请求，-c为每个进程的最大并发数。响应时间从计划发送时间开始计算，'
+                             u'停止时仍在排队、未能发出的请求计为dropped')
+    parser.add_argument('--scenario', metavar='FILE',
+                        help=u'场景文件，每行一个json格式的请求({"method", "url", "headers", "body", "weight", "group"}，除url外均可省略)'
+                             u'或一行common log format格式的访问日志。按group(默认为URL路径)分别统计')
+    parser.add_argument('--scenario-mode', dest='scenario_mode', choices=('weighted', 'replay'), default='weighted',
+                        help=u'weighted: 按权重随机选择请求(相同的请求会被合并，超过20000行时随机抽取20000行)；'
+                             u'replay: 各进程按顺序轮流回放文件中的请求，到末尾后从头开始(每个进程不超过20000行时只解析一遍)。默认weighted')
+    parser.add_argument('--ramp', metavar='FROM:TO:STEP',
+                        help=u'阶梯加压，每--step-duration秒将负载从FROM按STEP增加到TO，负载为-c(每个进程的并发数)，'
+                             u'使用--rate时为总速率。不满足--slo-*时停止，最后输出各阶梯的吞吐量和延迟及满足SLO的最高负载')
+    parser.add_argument('--step-duration', dest='step_duration', type=float, default=10,
+                        help=u'--ramp每个阶梯的秒数，默认10')
+    parser.add_argument('--slo-p99', dest='slo_p99', metavar='MS', type=float,
+                        help=u'--ramp的SLO：阶梯内响应时间p99应小于该毫秒数')
+    parser.add_argument('--slo-errors', dest='slo_errors', metavar='PERCENT', type=float,
+                        help=u'--ramp的SLO：阶梯内错误率应小于该百分比')
+    parser.add_argument('--stream', action='store_true',
+                        help=u'流式处理响应，不在内存中保留响应内容，只统计字节数并按--expect-*逐块校验')
+    parser.add_argument('--expect-size', dest='expect_size', metavar='BYTES', type=int,
+                        help=u'响应内容应有的字节数，不符时计为错误(invalid)。隐含--stream')
+    parser.add_argument('--expect-hash', dest='expect_hash', metavar='ALGO:HEX',
+                        help=u'响应内容应有的校验值，如crc32:1c291ca3或md5:<hex>，支持crc32及hashlib的算法。隐含--stream')
+    parser.add_argument('--expect-substring', dest='expect_substring', metavar='TEXT',
+                        help=u'响应内容中应包含的字符串(utf-8)。隐含--stream')
+    parser.add_argument('--duration', type=float, default=0,
+                        help=u'预热结束后运行的秒数，到时后等待未完成的请求结束再退出。默认一直运行到Ctrl-C')
+    parser.add_argument('--requests', type=int,
+                        help=u'预热结束后发送的请求总数(分摊到各进程)，发送完并等待响应后退出')
+    parser.add_argument('--warmup', type=float, default=0,
+                        help=u'预热秒数，预热期间发出的请求不计入统计')
+    parser.add_argument('--transport', choices=('pipe', 'shm'), default='pipe',
+                        help=u'子进程上报统计数据的方式：pipe(序列化后经管道发送)或shm(写入共享内存，由主进程定时读取)，默认pipe')
+    parser.add_argument('--output', metavar='FILE',
+                        help=u'每秒将该秒内的统计数据(请求数、错误数、状态码、响应时间分位数)写入该文件，.csv结尾时为csv格式，否则为json lines')
+    parser.add_argument('--output-format', dest='output_format', choices=('jsonl', 'csv'),
+                        help=u'--output的文件格式，默认由扩展名决定')
+    parser.add_argument('--summary', metavar='FILE',
+                        help=u'测试结束后将汇总结果以json格式写入该文件，默认为--output去掉扩展名加上.summary.json')
+    parser.add_argument('--agent', dest='agent_listen', metavar='[HOST:]PORT',
+                        help=u'以agent模式运行，监听该地址等待coordinator下发测试配置，只指定端口时监听127.0.0.1，'
+                             u'接受其他主机的连接需指定如0.0.0.0:PORT。通信未加密也未认证，只能在可信网络中使用')
+    parser.add_argument('--agents', dest='agents', metavar='HOST:PORT[,HOST:PORT...]',
+                        help=u'以coordinator模式运行，由这些agent产生压力(-f、-c为每个agent的参数，--rate为所有agent合计)，本机不启动子进程')
+    parser.add_argument('--serve', metavar='[HOST:]PORT',
+                        help=u'不压测，而是运行一个极简的HTTP目标服务器，用于测试本工具自身的性能')
+    parser.add_argument('--serve-size', dest='serve_size', metavar='BYTES', type=int, default=100,
+                        help=u'目标服务器响应内容的字节数，默认100')
+    parser.add_argument('--serve-delay', dest='serve_delay', metavar='MS', type=float, default=0,
+                        help=u'目标服务器每个响应延迟的毫秒数，默认0')
+    parser.add_argument('--serve-error-rate', dest='serve_error_rate', metavar='PERCENT', type=float, default=0,
+                        help=u'目标服务器返回500的请求百分比，默认0')
+    parser.add_argument('--serve-procs', dest='serve_procs', type=int, default=1,
+                        help=u'目标服务器的进程数，默认1')
+    parser.add_argument('--self-bench', dest='self_bench', action='store_true',
+                        help=u'自测：在本机启动目标服务器(--serve-*)，依次以各引擎、上报方式、开环/闭环模式压测--duration秒(默认5)，'
+                             u'输出每个worker核心的最大RPS和每个请求消耗的CPU时间。--summary写入json结果')
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(2)
     args = parser.parse_args()
+    if args.serve:
+        print(u'{:<15}{} (size {}, delay {:g}ms, error rate {:g}%, {} procs)'.format(
+            'Serve:', args.serve, args.serve_size, args.serve_delay, args.serve_error_rate, args.serve_procs))
+        return args
+    if args.self_bench:
+        if args.procs == 0:
+            args.procs = len(available_cpus())
+        args.duration = args.duration or 5
+        print(u'{:<15}-f {} -c {}, {:g}s per case, target size {}, delay {:g}ms, error rate {:g}%\n'.format(
+            'Self bench:', args.procs, args.coroutines, args.duration,
+            args.serve_size, args.serve_delay, args.serve_error_rate))
+        return args
+    if args.agent_listen:
+        print(u'{:<15}{}'.format('Agent:', args.agent_listen))
+        return args
+    if not args.url:
+        parser.error(u'缺少目标URL')
+    if args.engine == 'asyncio' and asyncio is None:
+        parser.error(u'asyncio引擎需要python3')
+    if args.pipeline < 1:
+        parser.error(u'--pipeline至少为1')
+    if args.requests is not None and args.requests < 1:
+        parser.error(u'--requests至少为1')
+    if args.ramp:
+        try:
+            first, last, step = [float(v) for v in args.ramp.split(':')]
+        except ValueError:
+            parser.error(u'--ramp格式为FROM:TO:STEP')
+        if step <= 0 or first <= 0 or last < first:
+            parser.error(u'--ramp需要0 < FROM <= TO且STEP > 0')
+        if args.duration or args.requests is not None:
+            parser.error(u'--ramp不能和--duration、--requests同时使用')
+        num_steps = int((last - first) / step + 1e-9) + 1
+        args.ramp = [first + i * step for i in range(num_steps)]
+        if args.rate > 0:
+            args.rate = args.ramp[0]
+        else:
+            args.ramp = [int(v) for v in args.ramp]
+            args.coroutines = args.ramp[0]
+    if args.expect_size is not None or args.expect_hash or args.expect_substring is not None:
+        args.stream = True
+    if args.expect_hash:
+        name = args.expect_hash.partition(':')[0]
+        if ':' not in args.expect_hash or (name != 'crc32' and name not in hashlib_algorithms()):
+            parser.error(u'--expect-hash格式为ALGO:HEX，ALGO为crc32或hashlib支持的算法')
     urlstr = u'{:<15}{}'.format('URL:', args.url)
-    procstr = u'{:<15}{}'.format('Processes:', args.procs)
+    if args.procs == 0 and not args.agents:
+        args.procs = len(available_cpus())
+    procstr = u'{:<15}{}'.format('Processes:', args.procs or 'auto')
     corstr = u'{:<15}{}'.format('Coroutines:', args.coroutines)
-    numdeli = max(len(urlstr), len(procstr), len(corstr))
-    print('\n{0}\n{1}\n{2}\n{3}\n{0}\n'.format(numdeli * '=', urlstr, procstr, corstr))
+    lines = [urlstr, procstr, corstr]
+    if args.cpu_affinity:
+        lines.append(u'{:<15}{}'.format('CPU affinity:', args.cpu_affinity))
+    if args.engine != 'tornado':
+        lines.append(u'{:<15}{} (pipeline {})'.format('Engine:', args.engine, args.pipeline))
+    if args.rate > 0:
+        lines.append(u'{:<15}{:g} #/s'.format('Rate:', args.rate))
+    if args.scenario:
+        lines.append(u'{:<15}{} ({})'.format('Scenario:', args.scenario, args.scenario_mode))
+    if args.stream:
+        checks = [u'{}={}'.format(k, v) for k, v in (('size', args.expect_size), ('hash', args.expect_hash),
+                                                       ('substring', args.expect_substring)) if v is not None]
+        lines.append(u'{:<15}{}'.format('Stream:', u', '.join(checks) or u'yes'))
+    if args.ramp:
+        slo = [u'{} < {:g}{}'.format(name, v, unit) for name, v, unit in (
+            ('p99', args.slo_p99, 'ms'), ('errors', args.slo_errors, '%')) if v is not None]
+        lines.append(u'{:<15}{:g} -> {:g}, {} steps of {:g}s, SLO: {}'.format(
+            'Ramp:', args.ramp[0], args.ramp[-1], len(args.ramp), args.step_duration, u', '.join(slo) or u'none'))
+    if args.warmup:
+        lines.append(u'{:<15}{:g}s'.format('Warmup:', args.warmup))
+    if args.duration:
+        lines.append(u'{:<15}{:g}s'.format('Duration:', args.duration))
+    if args.requests is not None:
+        lines.append(u'{:<15}{}'.format('Requests:', args.requests))
+    if args.agents:
+        lines.append(u'{:<15}{}'.format('Agents:', args.agents))
+    numdeli = max(len(l) for l in lines)
+    print(u'\n{0}\n{1}\n{0}\n'.format(numdeli * '=', u'\n'.join(lines)))
     return args
 
-def start_worker(url, num_coroutines, pipe_in, pipe_out):
+def parse_host_port(addr, default_host=''):
+    host, sep, port = addr.rpartition(':')
+    return (host if sep else default_host), int(port)
+
+def start_worker(args, worker_id, pipe_in, pipe_out, slots=None):
     signal.signal(signal.SIGINT, signal.SIG_IGN)
-    # clear loop instance inited in parent process
+    # clear loop instance inited in parent process, a new loop is needed
+    # since the inherited one may be running (the agent forks from a callback)
     tornado.ioloop.IOLoop.clear_instance()
-    loop = tornado.ioloop.IOLoop.instance()
+    loop = tornado.ioloop.IOLoop()
     loop.make_current()
+    if args.cpu_affinity:
+        cpus = parse_cpu_list(args.cpu_affinity)
+        set_cpu_affinity(cpus[worker_id % len(cpus)])
+
+    output = tornado.iostream.PipeIOStream(pipe_out)
+    if slots is not None:
+        reporter = ShmReporter(slots, worker_id, output)
+    else:
+        reporter = PipeReporter(output)
+    # parsing the scenario may take a while, the warm-up starts with the worker
+    source = make_request_source(args, worker_id)
+    worker = Worker(args, worker_id, reporter)
 
     cmd_stream = tornado.iostream.PipeIOStream(pipe_in)
     def process_cmd(data):
         cmd = SubCmd.load(data)
         if cmd.cmd == SubCmd.CmdExit:
-            global now_exit
-            now_exit = True
+            worker.stop()
+        elif cmd.cmd == SubCmd.CmdLoad:
+            worker.set_load(cmd.result)
+        cmd_stream.read_bytes(4, process_cmd_len)
 
     def process_cmd_len(data):
         strlen = struct.unpack('<I', data)[0]
         cmd_stream.read_bytes(strlen, process_cmd)
 
-    def on_cmd_read(fd, evs):
-        cmd_stream.read_bytes(4, process_cmd_len)
+    cmd_stream.read_bytes(4, process_cmd_len)
+    if args.rate > 0:
+        # every worker takes an equal share of the rate, the start times are
+        # staggered so that the workers do not send in bursts
+        worker.scheduler = RateScheduler(args.rate / args.procs, worker, worker_id / args.rate)
+    if args.engine == 'asyncio':
+        new_requests = functools.partial(start_raw_engine, args, source, worker)
+    else:
+        client = KeepAliveClient() if args.keepalive else None
+        new_requests = lambda n: [Request(source, worker, client) for i in range(n)]
+    worker.start(new_requests)
+    loop.start()
 
-    loop.add_handler(pipe_in, on_cmd_read, tornado.ioloop.IOLoop.READ)
-    output = tornado.iostream.PipeIOStream(pipe_out)
-    requests = [Request(url, output) for n in range(num_coroutines)]
+class ResultRecorder(object):
+    """Writes a snapshot of the stats of every interval as json lines or csv,
+    plus a json summary of the whole run at the end. Lines are formatted on
+    the loop but written by a thread, so a slow disk never stalls the loop."""
+    INTERVAL = 1000
+    CSV_FIELDS = ('time', 'elapsed', 'requests', 'errors', 'rate', 'new_conns', 'reused_conns', 'status') + tuple(
+        'resp_time_ms_' + k for k in ('min', 'p50', 'p90', 'p99', 'p99.9', 'max', 'avg'))
+
+    def __init__(self, args, result):
+        self.args = args
+        self.result = result
+        self.prev = None
+        self.prev_time = None
+        self.timer = None
+        # more top level items of the summary
+        self.extra = {}
+        self.summary_path = args.summary
+        if not args.output:
+            # summary only
+            return
+        self.output_format = args.output_format or ('csv' if args.output.endswith('.csv') else 'jsonl')
+        if not self.summary_path:
+            self.summary_path = os.path.splitext(args.output)[0] + '.summary.json'
+        self.queue = queue.Queue()
+        self.file = open(args.output, 'w')
+        self.thread = threading.Thread(target=self._write_lines)
+        self.thread.daemon = True
+        self.thread.start()
+        if self.output_format == 'csv':
+            self._put_csv(self.CSV_FIELDS)
+
+    def _write_lines(self):
+        while True:
+            line = self.queue.get()
+            if line is None:
+                break
+            self.file.write(line)
+        self.file.close()
+
+    def _put_csv(self, row):
+        buf = StringIO()
+        csv.writer(buf).writerow(row)
+        self.queue.put(buf.getvalue())
 
-    for r in requests:
-        r.run()
+    def start(self):
+        if not self.args.output:
+            return
+        self.prev = copy.deepcopy(self.result)
+        self.prev_time = time.time()
+        self.timer = tornado.ioloop.PeriodicCallback(self.record, self.INTERVAL)
+        self.timer.start()
+
+    def record(self):
+        now = time.time()
+        interval = self.result.diff(self.prev)
+        self.prev = copy.deepcopy(self.result)
+        snapshot = interval.to_dict(now - self.prev_time)
+        self.prev_time = now
+        snapshot['interval'] = snapshot['elapsed']
+        snapshot['time'] = now
+        snapshot['elapsed'] = now - self.result.begin_time
+        if self.output_format == 'csv':
+            resp_time = snapshot['resp_time_ms']
+            self._put_csv([snapshot['time'], snapshot['elapsed'], snapshot['requests'], snapshot['errors'],
+                           snapshot['rate'], snapshot['new_conns'], snapshot['reused_conns'],
+                           ' '.join('{}={}'.format(k, v) for k, v in sorted(snapshot['status'].items()))] +
+                          [resp_time[k] for k in ('min', 'p50', 'p90', 'p99', 'p99.9', 'max', 'avg')])
+        else:
+            self.queue.put(json.dumps(snapshot, sort_keys=True) + '\n')
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.stop()
+            self.record()
+        if self.args.output:
+            self.queue.put(None)
+            self.thread.join()
+        summary = self.result.to_dict(self.result.elapsed())
+        summary['args'] = dict((k, v) for k, v in vars(self.args).items() if not k.startswith('_'))
+        summary.update(self.extra)
+        with open(self.summary_path, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+class RampController(object):
+    """Steps the load through the --ramp values, one every --step-duration
+    seconds, without restarting the workers.
+
+    The load is -c of every worker, or the total rate in open-loop mode.
+    Every step is measured on its own, leaving out its first SETTLE part
+    while connections open and queues adjust to the new load, and checked
+    against the SLO. The run stops after the first step breaking it or
+    after the last step.
+    """
+    SETTLE = 0.2
+
+    def __init__(self, args, result, set_load, stop):
+        self.args = args
+        self.result = result
+        self.set_load = set_load
+        self.stop = stop
+        self.loads = args.ramp
+        self.index = 0
+        self.steps = []
+        self.prev = None
+        self.timeout = None
+
+    def start(self):
+        self._begin_step()
+
+    def _begin_step(self):
+        settle = self.args.step_duration * self.SETTLE
+        self.timeout = tornado.ioloop.IOLoop.current().call_later(settle, self._begin_measure)
+
+    def _begin_measure(self):
+        self.prev = copy.deepcopy(self.result)
+        self.timeout = tornado.ioloop.IOLoop.current().call_later(
+            self.args.step_duration * (1 - self.SETTLE), self._next_step)
+
+    def cancel(self):
+        if self.timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+
+    def _check_slo(self, step):
+        """Returns why step breaks the SLO, None if it does not."""
+        if step['requests'] == 0:
+            return 'no responses'
+        if self.args.slo_p99 and step['p99'] > self.args.slo_p99:
+            return 'p99 {:.2f}ms > {:g}ms'.format(step['p99'], self.args.slo_p99)
+        if self.args.slo_errors is not None and step['error_rate'] > self.args.slo_errors:
+            return 'errors {:.2f}% > {:g}%'.format(step['error_rate'], self.args.slo_errors)
+        return None
+
+    def _next_step(self):
+        self.timeout = None
+        interval = self.result.diff(self.prev)
+        step = {
+            'load': self.loads[self.index],
+            'requests': interval.num_requests,
+            'rate': interval.num_requests / (self.args.step_duration * (1 - self.SETTLE)),
+            'p50': interval.resp_hist.percentile(50) / 1000.0,
+            'p99': interval.resp_hist.percentile(99) / 1000.0,
+            'error_rate': interval.num_errors * 100.0 / interval.num_requests if interval.num_requests else 0.0,
+        }
+        step['broken'] = self._check_slo(step)
+        self.steps.append(step)
+        print('step {}/{}: load {:g} | rate {:.2f} #/s | p50 {:.2f} | p99 {:.2f} | errors {:.2f}% | {}'.format(
+            self.index + 1, len(self.loads), step['load'], step['rate'], step['p50'], step['p99'],
+            step['error_rate'], 'SLO broken: ' + step['broken'] if step['broken'] else 'ok'))
+        # keep the step line, the live view starts over below it
+        self.result._prev_show_lines = 0
+        self.index += 1
+        if step['broken'] or self.index == len(self.loads):
+            self.stop()
+            return
+        self.set_load(self.loads[self.index])
+        self._begin_step()
+
+    def best_load(self):
+        """Highest load of the steps meeting the SLO, the steps only go up so
+        this is the last one before the first broken step."""
+        best = None
+        for step in self.steps:
+            if step['broken']:
+                break
+            best = step['load']
+        return best
+
+    def to_dict(self):
+        return {'steps': self.steps, 'best_load': self.best_load(),
+                'load': 'rate' if self.args.rate > 0 else 'concurrency'}
+
+    def report(self):
+        print('ramp steps ({}):'.format('total rate' if self.args.rate > 0 else 'concurrency per process'))
+        print('    {:>10}{:>12}{:>10}{:>10}{:>11}  {}'.format('load', 'rate(#/s)', 'p50(ms)', 'p99(ms)', 'errors(%)', 'SLO'))
+        for step in self.steps:
+            print('    {:>10g}{:>12.2f}{:>10.2f}{:>10.2f}{:>11.2f}  {}'.format(
+                step['load'], step['rate'], step['p50'], step['p99'], step['error_rate'],
+                'broken: ' + step['broken'] if step['broken'] else 'ok'))
+        best = self.best_load()
+        print('{:<25}{}'.format('highest load within SLO:', 'none' if best is None else '{:g}'.format(best)))
+
+class WorkerPool(object):
+    """Runs the worker processes of this host and merges their results into
+    self.result, on_update is called with it whenever new results arrived.
+
+    The workers stop on their own once their share of --requests is done,
+    or after stop(). wait() resolves when all of them have exited.
+    """
+    def __init__(self, args, on_update=None):
+        if args.procs == 0:
+            # -f auto on an agent
+            args.procs = len(available_cpus())
+        self.args = args
+        self.on_update = on_update
+        self.result = LoadResult()
+        self.procs = []
+        self.cmd_pipes = []
+        self.readers = []
+        self.slots = SharedResultSlots(args.procs) if args.transport == 'shm' else None
+        self.slots_timer = None
+        self.stopping = False
+        # when the last worker sent its final result, the end of the run
+        self.finish_time = None
+
+    def start(self):
+        # the warm-up is not part of the results
+        self.result.begin_time = time.time() + self.args.warmup
+        for n in range(self.args.procs):
+            cmd_pipe_r, cmd_pipe_w = os.pipe()
+            # with shm transport the result pipe only carries group stats
+            res_pipe_r, res_pipe_w = os.pipe()
+            proc = multiprocessing.Process(target=start_worker, args=(self.args, n, cmd_pipe_r, res_pipe_w, self.slots))
+            proc.start()
+            os.close(cmd_pipe_r)
+            os.close(res_pipe_w)
+            self.procs.append(proc)
+
+            self.cmd_pipes.append(tornado.iostream.PipeIOStream(cmd_pipe_w))
+            self.readers.append(self._read_results(tornado.iostream.PipeIOStream(res_pipe_r)))
+
+        if self.slots is not None:
+            self.slots_timer = tornado.ioloop.PeriodicCallback(self._read_slots, 200)
+            self.slots_timer.start()
+
+    def _notify(self):
+        if self.on_update is not None and time.time() >= self.result.begin_time:
+            self.on_update(self.result)
+
+    @tornado.gen.coroutine
+    def _read_results(self, stream):
+        try:
+            while True:
+                cmd = yield SubCmd.read(stream)
+                if cmd.cmd == SubCmd.CmdResult:
+                    self.result.update(cmd.result)
+                    self._notify()
+                elif cmd.cmd == SubCmd.CmdExit:
+                    break
+        except tornado.iostream.StreamClosedError:
+            # the worker died without saying goodbye
+            pass
+        self.finish_time = time.time()
+        stream.close()
+
+    def _read_slots(self):
+        self.slots.read_into(self.result)
+        self._notify()
+
+    def stop(self):
+        """Ask the workers to finish their requests in flight and exit."""
+        if self.stopping:
+            return
+        self.stopping = True
+        for p in self.cmd_pipes:
+            try:
+                p.write(SubCmd(SubCmd.CmdExit).msg())
+            except tornado.iostream.StreamClosedError:
+                # already exited
+                pass
+
+    def set_load(self, load):
+        """Total rate of the pool in open-loop mode, -c of every worker
+        otherwise."""
+        if self.args.rate > 0:
+            load = float(load) / self.args.procs
+        for p in self.cmd_pipes:
+            try:
+                p.write(SubCmd(SubCmd.CmdLoad, load).msg())
+            except tornado.iostream.StreamClosedError:
+                pass
+
+    def terminate(self):
+        for p in self.procs:
+            if p.is_alive():
+                p.terminate()
+
+    @tornado.gen.coroutine
+    def finish(self):
+        """Resolves once every worker has sent its final result, self.result
+        is final then and ends with the last one."""
+        yield self.readers
+        if self.slots_timer is not None:
+            self.slots_timer.stop()
+            self.slots.read_into(self.result)
+        self.result.end_time = self.finish_time
+
+    @tornado.gen.coroutine
+    def wait(self):
+        """Same as finish(), then joins the workers."""
+        yield self.finish()
+        for p in self.procs:
+            p.join()
+        for p in self.cmd_pipes:
+            p.close()
+
+class AgentServer(tornado.tcpserver.TCPServer):
+    """Runs a WorkerPool with the args pushed by a coordinator and streams the
+    cumulative pool result back to it, serves one coordinator at a time."""
+    RESULT_INTERVAL = 500
+
+    def __init__(self):
+        super(AgentServer, self).__init__()
+        self.busy = False
+
+    @tornado.gen.coroutine
+    def _read_cmds(self, stream, pool):
+        try:
+            while True:
+                cmd = yield SubCmd.read(stream, remote=True)
+                if cmd.cmd == SubCmd.CmdExit:
+                    return
+                elif cmd.cmd == SubCmd.CmdLoad:
+                    pool.set_load(float(cmd.result))
+        except (tornado.iostream.StreamClosedError, ValueError, TypeError):
+            pass
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        if self.busy:
+            stream.close()
+            return
+        self.busy = True
+        print('coordinator {} connected'.format(address))
+        timer = None
+        try:
+            cmd = yield SubCmd.read(stream, remote=True)
+            if cmd.cmd != SubCmd.CmdConfig:
+                return
+            pool = WorkerPool(cmd.result)
+            yield stream.write(SubCmd(SubCmd.CmdReady).msg(remote=True))
+            cmd = yield SubCmd.read(stream, remote=True)
+            if cmd.cmd != SubCmd.CmdStart:
+                return
+            pool.start()
+            timer = tornado.ioloop.PeriodicCallback(
+                lambda: stream.write(SubCmd(SubCmd.CmdResult, pool.result).msg(remote=True)),
+                self.RESULT_INTERVAL)
+            timer.start()
+            # stop when the coordinator says so or goes away, the pool may
+            # also finish on its own with --requests
+            tornado.ioloop.IOLoop.current().add_future(
+                self._read_cmds(stream, pool), lambda future: pool.stop())
+            yield pool.finish()
+            timer.stop()
+            # before joining the workers, the coordinator ends the run with it
+            yield stream.write(SubCmd(SubCmd.CmdResult, pool.result).msg(remote=True))
+            yield stream.write(SubCmd(SubCmd.CmdExit).msg(remote=True))
+            yield pool.wait()
+        except tornado.iostream.StreamClosedError:
+            print('coordinator {} disconnected'.format(address))
+        except ValueError as e:
+            print('coordinator {} sent an invalid message, {}'.format(address, e))
+        finally:
+            if timer is not None:
+                timer.stop()
+            stream.close()
+            self.busy = False
+            print('coordinator {} done'.format(address))
+
+class Coordinator(object):
+    """Pushes the run args to every agent, starts them all at once and shows
+    the merged results. Agents report cumulative results, so the view is
+    just the sum of the latest result of every agent."""
+    def __init__(self, args):
+        self.args = args
+        self.addrs = [parse_host_port(a.strip(), '127.0.0.1') for a in args.agents.split(',')]
+        self.streams = []
+        self.agent_results = [None] * len(self.addrs)
+        self.result = LoadResult()
+        self.stopping = False
+        self.recorder = None
+        self.ramp = None
+        # when the last agent sent its final result, the end of the run
+        self.finish_time = None
+
+    @tornado.gen.coroutine
+    def run(self):
+        client = tornado.tcpclient.TCPClient()
+        self.streams = yield [client.connect(host, port) for host, port in self.addrs]
+        for i, stream in enumerate(self.streams):
+            config = copy.copy(self.args)
+            config.agents = None
+            config.rate = self.args.rate / len(self.streams)
+            if self.args.requests is not None:
+                config.requests = split_share(self.args.requests, len(self.streams), i)
+            stream.write(SubCmd(SubCmd.CmdConfig, config).msg(remote=True))
+        for stream in self.streams:
+            cmd = yield SubCmd.read(stream, remote=True)
+            if cmd.cmd != SubCmd.CmdReady:
+                raise RuntimeError('unexpected agent reply {}'.format(cmd.cmd))
+        # every agent is ready now, start them as close together as possible
+        for stream in self.streams:
+            stream.write(SubCmd(SubCmd.CmdStart).msg(remote=True))
+        self.result.begin_time = time.time() + self.args.warmup
+        if self.args.duration:
+            tornado.ioloop.IOLoop.current().call_later(
+                self.args.warmup + self.args.duration, self.stop)
+        if self.ramp is not None:
+            tornado.ioloop.IOLoop.current().call_later(self.args.warmup, self.ramp.start)
+        if self.recorder is not None:
+            self.recorder.start()
+        yield [self._collect(i, stream) for i, stream in enumerate(self.streams)]
+        self.result.end_time = self.finish_time
+
+    @tornado.gen.coroutine
+    def _collect(self, index, stream):
+        while True:
+            cmd = yield SubCmd.read(stream, remote=True)
+            if cmd.cmd == SubCmd.CmdResult:
+                self.agent_results[index] = cmd.result
+                self.result.clear()
+                for r in self.agent_results:
+                    self.result.update(r)
+                if not self.stopping and time.time() >= self.result.begin_time:
+                    self.result.show()
+            elif cmd.cmd == SubCmd.CmdExit:
+                # right after the final result of the agent
+                self.finish_time = time.time()
+                stream.close()
+                return
+
+    def set_load(self, load):
+        """Same as WorkerPool.set_load(), the rate is split across agents."""
+        if self.args.rate > 0:
+            load = float(load) / len(self.streams)
+        for stream in self.streams:
+            if not stream.closed():
+                stream.write(SubCmd(SubCmd.CmdLoad, load).msg(remote=True))
+
+    def stop(self):
+        if self.stopping:
+            return
+        self.stopping = True
+        if self.ramp is not None:
+            self.ramp.cancel()
+        print('\nWaiting for agents to exit...')
+        for stream in self.streams:
+            if not stream.closed():
+                stream.write(SubCmd(SubCmd.CmdExit).msg(remote=True))
+
+class TargetServer(tornado.tcpserver.TCPServer):
+    """Minimal HTTP/1.1 server to benchmark this tool against (--serve).
+
+    Every request gets the same prebuilt response of --serve-size bytes,
+    after --serve-delay ms, or a 500 response for --serve-error-rate percent
+    of the requests. Keep-alive and pipelining are supported, request
+    bodies are skipped by Content-Length.
+    """
+    def __init__(self, size, delay, error_rate):
+        super(TargetServer, self).__init__()
+        self.delay = delay / 1000.0
+        self.error_rate = error_rate
+        body = b'x' * size
+        self.responses = {}
+        for close in (False, True):
+            conn = 'Connection: close\r\n' if close else ''
+            self.responses[False, close] = (
+                'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n{}Content-Length: {}\r\n\r\n'.format(
+                    conn, size).encode('latin-1') + body)
+            self.responses[True, close] = (
+                'HTTP/1.1 500 Internal Server Error\r\n{}Content-Length: 0\r\n\r\n'.format(
+                    conn).encode('latin-1'))
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        stream.set_nodelay(True)
+        try:
+            while True:
+                head = yield stream.read_until(b'\r\n\r\n', max_bytes=65536)
+                head = head.lower()
+                pos = head.find(b'\r\ncontent-length:')
+                if pos >= 0:
+                    pos += len(b'\r\ncontent-length:')
+                    length = int(head[pos:head.find(b'\r\n', pos)])
+                    if length:
+                        yield stream.read_bytes(length)
+                close = (b'\r\nconnection: close' in head or
+                         (b' http/1.0\r\n' in head and b'\r\nconnection: keep-alive' not in head))
+                if self.delay:
+                    yield tornado.gen.sleep(self.delay)
+                error = self.error_rate > 0 and random.random() * 100 < self.error_rate
+                yield stream.write(self.responses[error, close])
+                if close:
+                    break
+        except (tornado.iostream.StreamClosedError, tornado.iostream.UnsatisfiableReadError, ValueError):
+            pass
+        stream.close()
+
+def run_target(args):
+    host, port = parse_host_port(args.serve)
+    server = TargetServer(args.serve_size, args.serve_delay, args.serve_error_rate)
+    server.bind(port, host or None)
+    # forks --serve-procs processes sharing the socket
+    server.start(args.serve_procs)
+    if args.cpu_affinity:
+        cpus = parse_cpu_list(args.cpu_affinity)
+        task_id = tornado.process.task_id() or 0
+        set_cpu_affinity(cpus[task_id % len(cpus)])
+    loop = tornado.ioloop.IOLoop.current()
+    def exit_handler(signum, frame):
+        loop.add_callback_from_signal(loop.stop)
+    signal.signal(signal.SIGINT, exit_handler)
+    signal.signal(signal.SIGTERM, exit_handler)
     loop.start()
 
-def main():
-    sub_procs = []
-    sub_cmd_pipes = []
-    sub_result_pipes = {}
+SELF_BENCH_ENGINES = (
+    ('tornado', []),
+    ('tornado -k', ['-k']),
+    ('asyncio', ['--engine', 'asyncio']),
+    ('asyncio pipeline 8', ['--engine', 'asyncio', '--pipeline', '8']),
+)
+SELF_BENCH_TRANSPORTS = ('pipe', 'shm')
+# the open-loop run goes at this share of the closed-loop rate
+SELF_BENCH_OPEN_LOAD = 0.5
 
-    args = parse_cmd_args()
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def _wait_listening(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+def _run_self_bench_case(args, url, extra_args):
+    """Runs this script against url and returns its summary, plus the CPU
+    seconds used by all of its processes."""
+    fd, summary_path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    cmd = [sys.executable, os.path.abspath(__file__), url, '-f', str(args.procs), '-c', str(args.coroutines),
+           '--summary', summary_path] + extra_args
+    # the usage of waited for grandchildren (the workers) is included too
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(cmd, stdout=devnull)
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(summary_path) as f:
+        summary = json.load(f)
+    os.unlink(summary_path)
+    summary['process_cpu_seconds'] = ((usage_after.ru_utime - usage.ru_utime) +
+                                      (usage_after.ru_stime - usage.ru_stime))
+    return summary
 
-    for n in range(args.procs):
-        cmd_pipe_r, cmd_pipe_w = os.pipe()
-        res_pipe_r, res_pipe_w = os.pipe()
-        proc = multiprocessing.Process(target=start_worker, args=(args.url, args.coroutines, cmd_pipe_r, res_pipe_w))
-        proc.start()
-        os.close(cmd_pipe_r)
-        os.close(res_pipe_w)
-        sub_procs.append(proc)
+def run_self_bench(args):
+    """Runs every engine, transport and mode of this tool against a local
+    TargetServer and shows how many requests a worker core can generate
+    and the CPU time all the processes of the tool spend per request.
 
-        sub_cmd_pipes.append(tornado.iostream.PipeIOStream(cmd_pipe_w))
-        sub_result_pipes[res_pipe_r] = tornado.iostream.PipeIOStream(res_pipe_r)
+    The CPU time of starting and stopping is measured by a run of a single
+    request per worker for every engine and transport, and left out.
+    """
+    cpus = available_cpus()
+    port = _free_port()
+    target_cmd = [sys.executable, os.path.abspath(__file__), '--serve', '127.0.0.1:{}'.format(port),
+                  '--serve-size', str(args.serve_size), '--serve-delay', str(args.serve_delay),
+                  '--serve-error-rate', str(args.serve_error_rate), '--serve-procs', str(args.serve_procs)]
+    bench_affinity = []
+    if len(cpus) > args.serve_procs:
+        # keep the target server off the cores of the workers
+        target_cmd += ['--cpu-affinity', ','.join(str(c) for c in cpus[-args.serve_procs:])]
+        bench_affinity = ['--cpu-affinity', ','.join(str(c) for c in cpus[:-args.serve_procs])]
+    with open(os.devnull, 'w') as devnull:
+        # in a process group of its own, with --serve-procs > 1 the forked
+        # servers have to be stopped along with their parent
+        target = subprocess.Popen(target_cmd, stdout=devnull, preexec_fn=os.setsid)
+    rows = []
+    try:
+        _wait_listening(port)
+        url = 'http://127.0.0.1:{}/'.format(port)
+        header = '{:<20}{:<10}{:<8}{:>10}{:>12}{:>12}{:>10}{:>8}'.format(
+            'engine', 'transport', 'mode', 'rps', 'rps/core', 'cpu us/req', 'p99(ms)', 'errors')
+        print(header)
+        for engine, engine_args in SELF_BENCH_ENGINES:
+            if '--engine' in engine_args and asyncio is None:
+                print('{:<20}skipped, needs python3'.format(engine))
+                continue
+            for transport in SELF_BENCH_TRANSPORTS:
+                base_args = engine_args + ['--transport', transport] + bench_affinity
+                overhead = _run_self_bench_case(args, url, base_args + ['--requests', str(args.procs)])['process_cpu_seconds']
+                closed_rate = None
+                for mode in ('closed', 'open'):
+                    extra_args = base_args + ['--duration', str(args.duration)]
+                    if mode == 'open':
+                        if not closed_rate:
+                            continue
+                        extra_args += ['--rate', str(closed_rate * SELF_BENCH_OPEN_LOAD)]
+                    summary = _run_self_bench_case(args, url, extra_args)
+                    worker_cpu = summary.get('generator', {}).get('cpu_seconds', 0)
+                    cpu = max(summary['process_cpu_seconds'] - overhead, 0)
+                    row = {
+                        'engine': engine, 'transport': transport, 'mode': mode,
+                        'rps': summary['rate'],
+                        'rps_per_core': summary['requests'] / worker_cpu if worker_cpu else 0.0,
+                        'cpu_us_per_request': cpu * 1000000 / summary['requests'] if summary['requests'] else 0.0,
+                        'p99_ms': summary['resp_time_ms']['p99'],
+                        'errors': summary['errors'],
+                    }
+                    if mode == 'closed':
+                        closed_rate = summary['rate']
+                    rows.append(row)
+                    print('{engine:<20}{transport:<10}{mode:<8}{rps:>10.0f}{rps_per_core:>12.0f}'
+                          '{cpu_us_per_request:>12.1f}{p99_ms:>10.2f}{errors:>8}'.format(**row))
+    finally:
+        os.killpg(target.pid, signal.SIGTERM)
+        target.wait()
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump({'self_bench': rows, 'args': vars(args)}, f, indent=2, sort_keys=True)
 
+def run_agent(args):
+    # only reachable from other hosts when asked for explicitly
+    host, port = parse_host_port(args.agent_listen, '127.0.0.1')
+    server = AgentServer()
+    server.listen(port, host)
+    loop = tornado.ioloop.IOLoop.instance()
     def exit_handler(signum, frame):
-        global now_exit
-        now_exit = True
+        loop.add_callback_from_signal(loop.stop)
     signal.signal(signal.SIGINT, exit_handler)
+    loop.start()
+    print('Bye')
 
-    result = LoadResult()
-    def process_cmd(data):
-        cmd = SubCmd.load(data)
-        if cmd.cmd == SubCmd.CmdResult:
-            result.update(cmd.result)
-            result.show()
+def make_recorder(args, result):
+    if args.output or args.summary:
+        return ResultRecorder(args, result)
+    return None
 
-    def process_cmd_len(stream, data):
-        strlen = struct.unpack('<I', data)[0]
-        stream.read_bytes(strlen, process_cmd)
+def run_coordinator(args):
+    coordinator = Coordinator(args)
+    coordinator.recorder = make_recorder(args, coordinator.result)
+    if args.ramp:
+        coordinator.ramp = RampController(args, coordinator.result, coordinator.set_load, coordinator.stop)
+    loop = tornado.ioloop.IOLoop.instance()
+    def exit_handler(signum, frame):
+        loop.add_callback_from_signal(coordinator.stop)
+    signal.signal(signal.SIGINT, exit_handler)
 
-    def on_cmd_read(fd, evs):
-        stream = sub_result_pipes[fd]
-        stream.read_bytes(4, functools.partial(process_cmd_len, stream))
+    def on_done(future):
+        loop.stop()
+        future.result()
+        if coordinator.recorder is not None:
+            if coordinator.ramp is not None:
+                coordinator.recorder.extra['ramp'] = coordinator.ramp.to_dict()
+            coordinator.recorder.close()
+        coordinator.result.report()
+        if coordinator.ramp is not None:
+            coordinator.ramp.report()
+        print('Bye')
+    loop.add_future(coordinator.run(), on_done)
+    loop.start()
+
+def main():
+    args = parse_cmd_args()
+    if args.serve:
+        return run_target(args)
+    if args.self_bench:
+        return run_self_bench(args)
+    if args.agent_listen:
+        return run_agent(args)
+    if args.agents:
+        return run_coordinator(args)
 
     loop = tornado.ioloop.IOLoop.instance()
-    for fd in sub_result_pipes.keys():
-        loop.add_handler(fd, on_cmd_read, tornado.ioloop.IOLoop.READ)
+    pool = WorkerPool(args, on_update=lambda result: result.show())
+    pool.start()
+    recorder = make_recorder(args, pool.result)
+    if recorder is not None:
+        recorder.start()
 
-    def try_exit():
-        global now_exit
-        if not now_exit:
+    def stop():
+        if pool.stopping:
+            # second Ctrl-C, do not wait for the requests in flight
+            pool.terminate()
             return
+        if ramp is not None:
+            ramp.cancel()
         print('\nWaiting for children to exit...')
-        for p in sub_cmd_pipes:
-            p.write(SubCmd(SubCmd.CmdExit).msg())
-        for p in sub_procs:
-            p.join()
-        tornado.ioloop.IOLoop.current().stop()
+        pool.stop()
+
+    ramp = None
+    if args.ramp:
+        ramp = RampController(args, pool.result, pool.set_load, stop)
+        loop.call_later(args.warmup, ramp.start)
+
+    def exit_handler(signum, frame):
+        loop.add_callback_from_signal(stop)
+    signal.signal(signal.SIGINT, exit_handler)
+    if args.duration:
+        loop.call_later(args.warmup + args.duration, stop)
+
+    def on_done(future):
+        loop.stop()
+        future.result()
+        if recorder is not None:
+            if ramp is not None:
+                recorder.extra['ramp'] = ramp.to_dict()
+            recorder.close()
+        pool.result.report()
+        if ramp is not None:
+            ramp.report()
         print('Bye')
-    tornado.ioloop.PeriodicCallback(try_exit, 1000).start()
+    loop.add_future(pool.wait(), on_done)
     loop.start()
 
 if __name__ == '__main__':